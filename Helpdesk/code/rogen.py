@@ -3,137 +3,130 @@ import numpy as np
 import torch
 from torch import nn, optim, autograd
 import pandas as pd
+import os
 from numpy import vstack, argmax
 from sklearn.metrics import accuracy_score
-from jellyfish._jellyfish import damerau_levenshtein_distance
 import copy
 from nltk.util import ngrams
 pd.options.mode.chained_assignment = None  # default='warn'
 import torchvision.transforms as transforms
 from tqdm import tqdm
+from suffix import suffix_prediction, suffix_sampling
+from checkpoint import save_checkpoint, load_checkpoint, restore_checkpoint
+from early_stopping import EarlyStopping, validation_split, validation_loss
+from data_cache import read_csv_array
+from ensemble import Ensemble
+from precision import autocast
+from compiled import Compiled
+from quantize import quantize_model, model_device, model_bytes
+from distributed import launch, rank_and_world_size, broadcast_parameters, all_reduce_gradients
 import math
+from time import perf_counter
 import random
 import argparse
 
 random.seed(20)
 
-def suffix_prediction(model, X_test, Y_test, X_train, Y_train, generalized_data):
-    
-
-    l1_loss = nn.L1Loss()
-
-    case_length = []
-    current_case_length = 1
-    X_test = X_train
-    Y_test = Y_train
-
-    for i in tqdm(range(1, X_test.shape[0]), desc = "finding case lengths"):
-        current_case = X_test[i, :, 0]
-        temp = torch.count_nonzero(current_case).detach().cpu().numpy()
-        if temp == 1:
-            current_case_length = list(range(current_case_length, 0, -1))
-            case_length.extend(current_case_length)
-            current_case_length = 1
-        else:
-            current_case_length += 1
-    
-    current_case_length = list(range(current_case_length, 0, -1))
-    case_length.extend(current_case_length)
-    total_dl_distance = 0.0
-    total_time_mae = 0.0
-    count = 0
-    valid_case_count = 0
-    for i in tqdm(range(0, X_test.shape[0]), desc="suffix prediction"):
-        current_case = X_test[i, :, :]
-        current_case = current_case.unsqueeze_(0)
-        
-        predicted_case = current_case
-
-        number_to_predict = case_length[i]
-        
-        if number_to_predict > 5:
-            continue
-        valid_case_count += 1
-
-        ground_truth_labels = Y_test[i:(i+number_to_predict), 0].detach().cpu().numpy().tolist()
-        ground_truth_labels = [int(i) for i in ground_truth_labels]
-
-        ground_truth_labels = map(str, ground_truth_labels)    
-        ground_truth_labels = ''.join(ground_truth_labels)      
-
-        ground_truth_timestamps = torch.sum(Y_test[i:(i+number_to_predict), 1])
-
-        case_labels = []
-        case_time_acc = torch.zeros(1).cuda()
-
-        for j in range(0, number_to_predict):
-            logits, time = model(predicted_case)
-            preds = torch.argmax(logits, dim=1)[0].float()
-
-            resource = predicted_case[0, -1, 2]
-
-            if generalized_data:
-                generalization = predicted_case[0, -1, 3]
-                predicted_row = torch.tensor([preds, time, resource, generalization]).cuda()
-            else:
-                predicted_row = torch.tensor([preds, time, resource]).cuda()
-
-            if (j+1) != number_to_predict:
-                predicted_case[0, -(j+2), :] = predicted_case[0, -(j+1), :]
-                predicted_case[0, -(j+1), :] = predicted_row
-
-            preds = preds.detach().cpu().numpy().tolist()
-            case_labels.append(preds)
-            case_time_acc = case_time_acc + time[0]
-        
-        case_labels = [int(i) for i in case_labels]
-        case_labels = map(str, case_labels)    
-        case_labels = ''.join(case_labels)    
-        
-        dist = 1 - (damerau_levenshtein_distance(case_labels, ground_truth_labels) /
-                         max((len(case_labels), len(ground_truth_labels))))
-        total_dl_distance = total_dl_distance + dist
-        total_time_mae = total_time_mae + l1_loss(case_time_acc[0], ground_truth_timestamps).detach().cpu().numpy()
-    
-    total_dl_distance = total_dl_distance / valid_case_count
-    total_time_mae = total_time_mae / valid_case_count
-    print("DL Distance")
-    print(total_dl_distance)
-    print("Timestamp MAE")
-    print(total_time_mae)
-
 class RNN(nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers, num_classes):
+    def __init__(self, input_size, hidden_size, num_layers, num_classes, init_state='zeros', architecture='two_tower'):
         super(RNN, self).__init__()
         self.hidden_size = hidden_size
         self.num_layers = num_layers
+        self.architecture = architecture
         self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
-        self.lstm_timestamp = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
+        if architecture == 'two_tower':
+            self.lstm_timestamp = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
         self.fc = nn.Linear(hidden_size, num_classes)
         self.fc_timestamp = nn.Linear(hidden_size, 1)
+        if architecture == 'shared_adapter':
+            self.adapter = nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.ReLU())
+            self.adapter_timestamp = nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.ReLU())
+        self.init_state = init_state
+        if init_state == 'learned':
+            self.h0 = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+            self.c0 = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+            if architecture == 'two_tower':
+                self.ht = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+                self.ct = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+        self._zero_states = {}
+
+    def initial_states(self, x):
+        batch_size = x.size(0)
+        if self.init_state == 'learned':
+            learned = (self.h0, self.c0, self.ht, self.ct) if self.architecture == 'two_tower' else (self.h0, self.c0) * 2
+            states = [state.expand(-1, batch_size, -1) for state in learned]
+            if x.is_cuda:
+                # cuDNN rejects strided hidden states
+                states = [state.contiguous() for state in states]
+            return states
+        if self.init_state == 'xavier':
+            states = [torch.zeros(self.num_layers, batch_size, self.hidden_size, device=x.device) for _ in range(4)]
+            for state in states:
+                torch.nn.init.xavier_uniform_(state)
+            return states
+        # The LSTMs never write to their initial states, so one zero tensor per batch shape is reused
+        key = (batch_size, x.device)
+        if key not in self._zero_states:
+            if len(self._zero_states) >= 16:
+                self._zero_states.clear()
+            self._zero_states[key] = torch.zeros(self.num_layers, batch_size, self.hidden_size, device=x.device)
+        zeros = self._zero_states[key]
+        return [zeros] * 4
     
     def forward(self, x):
-        # Set initial hidden and cell states 
-        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
-        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
-        
-        ht = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
-        ct = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
+        out, out_timestamp, _ = self.step(x)
+        return out, out_timestamp
+
+    def step(self, x, states=None):
+        # Like forward, but the LSTMs start from states, the (h, c) pairs returned by an
+        # earlier call, so a decoder can feed only the newest event instead of the window
+        if states is None:
+            # Set initial hidden and cell states
+            h0, c0, ht, ct = self.initial_states(x)
+            states = ((h0, c0), (ht, ct))
 
         # Forward propagate LSTM
-        out, _ = self.lstm(x, (h0, c0))  # out: tensor of shape (batch_size, seq_length, hidden_size)
-        out_timestamp, _ = self.lstm_timestamp(x, (ht, ct))  # out: tensor of shape (batch_size, seq_length, hidden_size)
-        
+        out, state = self.lstm(x, states[0])  # out: tensor of shape (batch_size, seq_length, hidden_size)
+        if self.architecture == 'two_tower':
+            out_timestamp, state_timestamp = self.lstm_timestamp(x, states[1])  # out: tensor of shape (batch_size, seq_length, hidden_size)
+        else:
+            out_timestamp, state_timestamp = out, None
+
         # Decode the hidden state of the last time step
-        out = self.fc(out[:, -1, :])
-        out_timestamp = self.fc_timestamp(out_timestamp[:, -1, :])
+        out = out[:, -1, :]
+        out_timestamp = out_timestamp[:, -1, :]
+        if self.architecture == 'shared_adapter':
+            out = self.adapter(out)
+            out_timestamp = self.adapter_timestamp(out_timestamp)
+        out = self.fc(out)
+        out_timestamp = self.fc_timestamp(out_timestamp)
         out_timestamp = torch.flatten(out_timestamp)
-        return out, out_timestamp
+        # float32 predictions also under bfloat16 autocast
+        return out.float(), out_timestamp.float(), (state, state_timestamp)
 
 def mean_accuracy(logits, y):
     preds = torch.argmax(logits, dim=1).float()
     return (preds == y).float().mean()
 
+def evaluate(model, X, Y, batch_size, precision='float32'):
+    # Deterministic pass over the whole environment, chunked to bound memory
+    device = model_device(model)
+    # An ensemble predicts for every member in turn, its scores are the members' mean
+    members = getattr(model, 'members', 1)
+    model.eval()
+    correct = torch.zeros((), device=device)
+    abs_error = torch.zeros((), device=device)
+    with torch.no_grad():
+        for start in range(0, len(X), batch_size):
+            X_batch = X[start:start + batch_size].to(device)
+            Y_batch = Y[start:start + batch_size].to(device).repeat(members, 1)
+            with autocast(device, precision):
+                logits, time = model(X_batch)
+            correct += (torch.argmax(logits, dim=1).float() == Y_batch[:,0]).sum()
+            abs_error += torch.abs(time - Y_batch[:,1]).sum()
+    model.train()
+    return (correct / (len(X) * members)).cpu().numpy(), (abs_error / (len(X) * members)).cpu().numpy()
+
 def pretty_print(*values):
     col_width = 20
 
@@ -158,26 +151,47 @@ def time_penalty(logits, y):
     grad = autograd.grad(loss, [scale], create_graph=True)[0]
     return torch.sum(grad)
 
-def run(data, suffix):
+def squared_weight_norm(model):
+    # One fused multi-tensor kernel over all parameters, on the model's device. For an
+    # ensemble the mean over its members, like its losses.
+    norms = torch._foreach_norm(list(model.parameters()))
+    return torch.stack(norms).pow(2).sum() / getattr(model, 'members', 1)
+
+def load_end_of_case(path, *label_columns):
+    # The preprocessors code the end-of-case activity after every activity and list it
+    # in the vocabulary
+    if os.path.exists(path):
+        vocabulary = pd.read_csv(path)
+        codes = vocabulary.loc[vocabulary['activity'] == 'end of case', 'code']
+        if codes.empty:
+            raise ValueError('no end of case activity in ' + path)
+        return int(codes.iloc[0])
+    # Data preprocessed before the vocabulary was persisted: fall back to the largest code
+    return max(int(column.max()) for column in label_columns)
+
+def run(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     sequence_length = 10
 
-    if data == 'orig':
-        env1_X = pd.read_csv('../data/Helpdesk_env1_X.csv').to_numpy()
-        env1_Y = pd.read_csv('../data/Helpdesk_env1_Y.csv').to_numpy()
-        env2_X = pd.read_csv('../data/Helpdesk_env2_X.csv').to_numpy()
-        env2_Y = pd.read_csv('../data/Helpdesk_env2_Y.csv').to_numpy()
-        env3_X = pd.read_csv('../data/Helpdesk_env3_X.csv').to_numpy()
-        env3_Y = pd.read_csv('../data/Helpdesk_env3_Y.csv').to_numpy()
-
-    if data == 'gen':
-        env1_X = pd.read_csv('../data/Helpdesk_gen_env1_X.csv').to_numpy()
-        env1_Y = pd.read_csv('../data/Helpdesk_gen_env1_Y.csv').to_numpy()
-        env2_X = pd.read_csv('../data/Helpdesk_gen_env2_X.csv').to_numpy()
-        env2_Y = pd.read_csv('../data/Helpdesk_gen_env2_Y.csv').to_numpy()
-        env3_X = pd.read_csv('../data/Helpdesk_gen_env3_X.csv').to_numpy()
-        env3_Y = pd.read_csv('../data/Helpdesk_gen_env3_Y.csv').to_numpy()
+    eoc = 'eoc_' if args.end_of_case else ''
+    if args.data == 'orig':
+        vocabulary_path = f'../data/Helpdesk_{eoc}activities.csv'
+        env1_X = read_csv_array(f'../data/Helpdesk_{eoc}env1_X.csv')
+        env1_Y = read_csv_array(f'../data/Helpdesk_{eoc}env1_Y.csv')
+        env2_X = read_csv_array(f'../data/Helpdesk_{eoc}env2_X.csv')
+        env2_Y = read_csv_array(f'../data/Helpdesk_{eoc}env2_Y.csv')
+        env3_X = read_csv_array(f'../data/Helpdesk_{eoc}env3_X.csv')
+        env3_Y = read_csv_array(f'../data/Helpdesk_{eoc}env3_Y.csv')
+
+    if args.data == 'gen':
+        vocabulary_path = f'../data/Helpdesk_gen_{eoc}activities.csv'
+        env1_X = read_csv_array(f'../data/Helpdesk_gen_{eoc}env1_X.csv')
+        env1_Y = read_csv_array(f'../data/Helpdesk_gen_{eoc}env1_Y.csv')
+        env2_X = read_csv_array(f'../data/Helpdesk_gen_{eoc}env2_X.csv')
+        env2_Y = read_csv_array(f'../data/Helpdesk_gen_{eoc}env2_Y.csv')
+        env3_X = read_csv_array(f'../data/Helpdesk_gen_{eoc}env3_X.csv')
+        env3_Y = read_csv_array(f'../data/Helpdesk_gen_{eoc}env3_Y.csv')
     
     number_of_features = env1_X.shape[1]
     # Reshape into Number of sequences * length of each sequence (Ngram) * Number of features for each tuple
@@ -190,110 +204,266 @@ def run(data, suffix):
     X_test = env3_X
     Y_test = env3_Y
 
-    X_train = torch.Tensor(X_train).cuda()
-    Y_train = torch.Tensor(Y_train).cuda()
-    X_test = torch.Tensor(X_test).cuda()
-    Y_test = torch.Tensor(Y_test).cuda()
+    X_train = torch.Tensor(X_train).to(device)
+    Y_train = torch.Tensor(Y_train).to(device)
+    X_test = torch.Tensor(X_test).to(device)
+    Y_test = torch.Tensor(Y_test).to(device)
     env1_X = torch.Tensor(env1_X)
     env1_Y = torch.Tensor(env1_Y)
     env2_X = torch.Tensor(env2_X)
     env2_Y = torch.Tensor(env2_Y)
 
+    validation_X = validation_Y = None
+    if args.patience > 0:
+        # Hold out the last cases of every training environment
+        env1_X, env1_Y, env1_validation_X, env1_validation_Y = validation_split(env1_X, env1_Y, args.validation_fraction)
+        env2_X, env2_Y, env2_validation_X, env2_validation_Y = validation_split(env2_X, env2_Y, args.validation_fraction)
+        validation_X = torch.cat((env1_validation_X, env2_validation_X))
+        validation_Y = torch.cat((env1_validation_Y, env2_validation_Y))
+
+    environments = [('env1', env1_X, env1_Y), ('env2', env2_X, env2_Y), ('test', X_test, Y_test)]
+    if validation_X is not None:
+        environments.append(('validation', validation_X, validation_Y))
+
     input_size = number_of_features
-    hidden_size = 120
+    hidden_size = 120 if args.hidden_size is None else args.hidden_size
     num_layers = 2
     num_classes = 15
+    if args.end_of_case:
+        end_of_case = load_end_of_case(vocabulary_path, Y_train[:,0], Y_test[:,0])
+        num_classes = max(num_classes, end_of_case + 1)
+    else:
+        end_of_case = None
     steps = 501
-    lr = 0.05
-    n_restarts = 1
-    penalty_weight = 10
+    lr = 0.05 if args.lr is None else args.lr
+    n_restarts = 1 if args.restarts is None else args.restarts
+    members = n_restarts if args.ensemble else 1
+    penalty_weight = 10 if args.penalty_weight is None else args.penalty_weight
     penalty_anneal_iters = 1
-    l2_weight = 0.0007
+    l2_weight = 0.0007 if args.l2_weight is None else args.l2_weight
 
     l1_loss = nn.L1Loss()
 
-    for restart in range(n_restarts):
-        print("Restart ", restart)
-        pretty_print('step', 'Next Activity Acc', 'Timestamp Acc')
-        model = RNN(input_size, hidden_size, num_layers, num_classes).to(device)
+    # With several processes, each trains on its own share of the environments
+    rank, world_size = rank_and_world_size()
+    training_environments = [(env1_X, env1_Y), (env2_X, env2_Y)]
+    if world_size > len(training_environments):
+        raise ValueError('%d processes for %d training environments' % (world_size, len(training_environments)))
+    owned_environments = range(rank, len(training_environments), world_size)
+
+    results = None
+    checkpoint = None
+    if args.resume and args.checkpoint is not None and os.path.exists(args.checkpoint):
+        checkpoint = load_checkpoint(args.checkpoint)
+
+    for restart in range(0, n_restarts, members):
+        if checkpoint is not None and checkpoint['restart'] > restart:
+            continue
+        if args.evaluate_only and (checkpoint is None or checkpoint['restart'] != restart):
+            # Only the checkpointed restart has trained weights, the others would be
+            # evaluated untrained
+            continue
+        if rank == 0:
+            print("Restart ", restart)
+            pretty_print('step', 'environment', 'Next Activity Acc', 'Timestamp Acc')
+        models = [RNN(input_size, hidden_size, num_layers, num_classes, args.init_state, args.architecture) for _ in range(members)]
+        model = (Ensemble(models) if args.ensemble else models[0]).to(device)
 
         optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
+        early_stopping = EarlyStopping(args.patience, args.min_delta) if args.patience > 0 else None
+
+        first_step = 0
+        if checkpoint is not None and checkpoint['restart'] == restart:
+            first_step = restore_checkpoint(checkpoint, model, optimizer, None, early_stopping)
+            penalty_weight = checkpoint['penalty_weight']
+            if rank == 0:
+                print("Resuming from step", first_step)
+        last_step = first_step if args.evaluate_only else steps
+        broadcast_parameters(model)
+
+        # The IRM penalties differentiate twice and stay eager, only the forward pass is compiled
+        forward = Compiled(model, 'model forward') if args.compile else model
+
+        first_step_seconds = None
+        start = perf_counter()
         # Train the model
-        for step in range(steps):
-            X = env1_X
-            Y = env1_Y
-            X, Y = X.cuda(), Y.cuda()   
-            env1_logits, env1_time = model(X)
-
-            env1_labels = Y[:,0].type(torch.LongTensor).cuda()
-            env1_loss = torch.nn.functional.cross_entropy(env1_logits, env1_labels)
-            env1_penalty = penalty(env1_logits,env1_labels)
-
-            env1_time_labels = Y[:,1].type(torch.LongTensor).cuda()
-            env1_time_loss = l1_loss(env1_time, env1_time_labels)
-            env1_time_penalty = time_penalty(env1_time, env1_time_labels)
-
-            X = env2_X
-            Y = env2_Y
-            X, Y = X.cuda(), Y.cuda()   
-            env2_logits, env2_time = model(X)
-
-            env2_labels = Y[:,0].type(torch.LongTensor).cuda()
-            env2_loss = torch.nn.functional.cross_entropy(env2_logits, env2_labels)
-            env2_penalty = penalty(env2_logits,env2_labels)
-
-            env2_time_labels = Y[:,1].type(torch.LongTensor).cuda()
-            env2_time_loss = l1_loss(env2_time, env2_time_labels)
-            env2_time_penalty = time_penalty(env2_time, env2_time_labels)
-
-            train_nll = torch.stack([env1_loss, env2_loss, env1_time_loss, env2_time_loss]).mean()
-            train_penalty = torch.stack([env1_penalty, env2_penalty, env1_time_penalty, env2_time_penalty]).mean()
-            weight_norm = torch.tensor(0.)
-            for w in model.parameters():
-                weight_norm = weight_norm + w.norm().pow(2)
-            
-            loss = train_nll.clone()
-            loss = loss + (l2_weight * weight_norm)
-            penalty_weight = (penalty_weight 
-                if step >= penalty_anneal_iters else 1.0)
-            loss = loss + (penalty_weight * train_penalty)
-            if penalty_weight > 1.0:
-                # Rescale the entire loss to keep gradients in a reasonable range
-                loss /= penalty_weight
-            
+        for step in range(first_step, last_step):
+            if step == first_step + 1:
+                # The first step, which compiles with --compile, is timed on its own
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                first_step_seconds = perf_counter() - start
+                start = perf_counter()
+            # The penalty is annealed in after penalty_anneal_iters steps
+            current_weight = penalty_weight if step >= penalty_anneal_iters else 1.0
+            # Rescale the entire loss to keep gradients in a reasonable range
+            loss_scale = current_weight if current_weight > 1.0 else 1.0
+            # Each process adds up the terms of its own environments and the weight norm's
+            # share, so that the gradients summed over the processes are those of the mean
+            terms = 2 * len(training_environments)
+
             optimizer.zero_grad()
-            loss.backward()
+            for env in owned_environments:
+                X, Y = training_environments[env]
+                # The batch goes through the model in micro-batches that each free their graph
+                # after the backward pass. The losses are means and the penalties gradients of
+                # means, so a micro-batch's terms weighted by its share of the batch add up to
+                # the terms of the whole batch, and so do their gradients.
+                micro_batch_size = args.micro_batch_size or len(X)
+                for micro_X, micro_Y in zip(X.split(micro_batch_size), Y.split(micro_batch_size)):
+                    share = len(micro_X) / (len(X) * terms)
+                    micro_X, micro_Y = micro_X.to(device), micro_Y.to(device).repeat(members, 1)
+                    with autocast(device, args.precision):
+                        env_logits, env_time = forward(micro_X)
+
+                    env_labels = micro_Y[:,0].type(torch.LongTensor).to(device)
+                    env_time_labels = micro_Y[:,1].type(torch.LongTensor).to(device)
+                    env_nll = share * (torch.nn.functional.cross_entropy(env_logits, env_labels) + l1_loss(env_time, env_time_labels))
+                    env_penalty = share * (penalty(env_logits,env_labels) + time_penalty(env_time, env_time_labels))
+                    ((env_nll + current_weight * env_penalty) / loss_scale).backward()
+                    del micro_X, micro_Y, env_logits, env_time
+
+            weight_norm = squared_weight_norm(model) / world_size
+            (l2_weight * weight_norm / loss_scale).backward()
+            all_reduce_gradients(model)
             optimizer.step()
             
-            with torch.no_grad():
-                X = X_test
-                Y = Y_test
-                X, Y = X.cuda(), Y.cuda()
-                logits, time = model(X)
-                test_acc = mean_accuracy(logits, Y[:,0])
-                time_test_acc = l1_loss(time, Y[:,1])
-                del logits
-
-            if step % 50 == 0:
-                pretty_print(
-                    np.int32(step),
-                    test_acc.detach().cpu().numpy(),
-                    time_test_acc.detach().cpu().numpy(),
-                )
-
-        if suffix == 'True':
-            if data == 'orig':
-                suffix_prediction(model, X_test, Y_test, X_train,Y_train, False)
-            if data == 'gen':
-                    suffix_prediction(model, X_test, Y_test, X_train,Y_train, True)
+            if rank == 0 and step % args.eval_interval == 0:
+                for name, env_X, env_Y in environments:
+                    acc, mae = evaluate(model, env_X, env_Y, args.eval_batch_size, args.precision)
+                    pretty_print(np.int32(step), name, acc, mae)
+
+            if early_stopping is not None and (step + 1) % args.validation_interval == 0:
+                loss = validation_loss(model, validation_X, validation_Y, args.eval_batch_size, args.precision)
+                if early_stopping.step(model, loss, step + 1):
+                    if rank == 0:
+                        print("Early stopping at step", step + 1, "best validation loss", early_stopping.best_loss, "at step", early_stopping.best_step)
+                    last_step = step + 1
+                    break
+
+            if rank == 0 and args.checkpoint is not None and ((step + 1) % args.checkpoint_interval == 0 or step + 1 == steps):
+                save_checkpoint(args.checkpoint, model, optimizer, None, early_stopping, step=step + 1, restart=restart, penalty_weight=penalty_weight)
+
+        if early_stopping is not None and last_step > first_step:
+            early_stopping.restore(model)
+            if rank == 0 and args.checkpoint is not None:
+                # The restored model finishes the run, resuming does not train it further
+                save_checkpoint(args.checkpoint, model, optimizer, None, early_stopping, step=steps, restart=restart, penalty_weight=penalty_weight)
+
+        if rank > 0:
+            # The first process reports the results
+            continue
 
-def main():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        seconds_per_step = (perf_counter() - start) / max(last_step - first_step - (first_step_seconds is not None), 1)
+        test_acc, test_mae = evaluate(model, X_test, Y_test, args.eval_batch_size, args.precision)
+        if last_step > first_step:
+            print('Seconds per step', seconds_per_step, 'first step', first_step_seconds)
+        results = {
+            'parameters': sum(p.numel() for p in model.parameters()) // members,
+            'seconds_per_step': seconds_per_step,
+            'first_step_seconds': first_step_seconds,
+            'test_acc': test_acc,
+            'test_mae': test_mae,
+        }
+
+        trained = model.unstack() if args.ensemble else [model]
+        if args.quantize:
+            # Test metrics and suffix decoding of int8 copies of the trained models
+            trained = [quantize_model(member) for member in trained]
+            results['test_acc'], results['test_mae'] = np.array([evaluate(member, X_test, Y_test, args.eval_batch_size) for member in trained], dtype=float).mean(axis=0)
+        results['model_bytes'] = model_bytes(trained[0])
+        if args.evaluate_only:
+            # No training step reports the checkpointed model's test metrics
+            pretty_print(np.int32(first_step), 'test', np.float64(results['test_acc']), np.float64(results['test_mae']))
+        if args.ensemble:
+            member_results = np.array([evaluate(member, X_test, Y_test, args.eval_batch_size, args.precision) for member in trained], dtype=float)
+            pretty_print('restarts', 'Next Activity Acc', 'Timestamp Acc')
+            pretty_print('mean', *member_results.mean(axis=0))
+            pretty_print('std', *member_results.std(axis=0))
+            results['test_acc_std'], results['test_mae_std'] = member_results.std(axis=0)
+
+        if args.suffix == 'True':
+            suffix_scores = []
+            suffix_seconds = 0.0
+            for trained_restart, trained_model in enumerate(trained, restart):
+                results_path = args.suffix_results
+                if results_path is not None and n_restarts > 1:
+                    # One results file per restart
+                    stem, extension = os.path.splitext(results_path)
+                    results_path = '%s_restart%d%s' % (stem, trained_restart, extension)
+                suffix_start = perf_counter()
+                suffix_scores.append(suffix_prediction(trained_model, X_train, Y_train, 5, args.suffix_batch_size, args.incremental,
+                                                       args.suffix_cache_size, args.beam_width, args.length_penalty,
+                                                       end_of_case, args.suffix_length_cap, results_path,
+                                                       args.suffix_workers, args.suffix_threads, args.precision))
+                suffix_seconds += perf_counter() - suffix_start
+                if args.suffix_samples > 0:
+                    samples_path = None
+                    if results_path is not None:
+                        # The sampled summaries go next to the suffix predictions
+                        stem, extension = os.path.splitext(results_path)
+                        samples_path = '%s_samples%s' % (stem, extension)
+                    sampled_rows, time_quantiles, sequence_frequencies = suffix_sampling(
+                        trained_model, X_train, Y_train, 5, args.suffix_samples, args.suffix_batch_size,
+                        args.incremental, args.temperature, args.top_k, end_of_case, args.suffix_length_cap,
+                        precision=args.precision, results_path=samples_path)
+                    results.setdefault('suffix_sample_rows', []).append(sampled_rows)
+                    results.setdefault('suffix_sample_time_quantiles', []).append(time_quantiles)
+                    results.setdefault('suffix_sample_frequencies', []).append(sequence_frequencies)
+            results['suffix_similarity'], results['suffix_mae'] = np.mean(suffix_scores, axis=0)
+            results['suffix_seconds'] = suffix_seconds / len(trained)
+
+    return results
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--data', help='which dataset to use, gen or orig',default='gen')
     parser.add_argument('-s', '--suffix', help='compute suffix', default='False')
-    args = parser.parse_args()
-    run(args.data, args.suffix)
+    parser.add_argument('--suffix_batch_size', help='prefixes decoded together during suffix prediction', type=int, default=1024)
+    parser.add_argument('--incremental', help='carry the LSTM states between suffix decoding steps and feed only the new event, instead of re-running the sliding window', action='store_true')
+    parser.add_argument('--suffix_cache_size', help='prefix windows whose decoded suffix is kept for reuse, 0 disables the cache', type=int, default=65536)
+    parser.add_argument('--beam_width', help='partial suffixes kept per prefix during suffix prediction, 1 decodes greedily', type=int, default=1)
+    parser.add_argument('--length_penalty', help='exponent of the suffix length that beam scores are divided by', type=float, default=1.0)
+    parser.add_argument('--end_of_case', help='train on the eoc_ files that close every case with an end-of-case activity, and decode suffixes until it is predicted', action='store_true')
+    parser.add_argument('--suffix_length_cap', help='events decoded at most per prefix when decoding until the end of case', type=int, default=50)
+    parser.add_argument('--suffix_results', help='CSV file that per-prefix suffix predictions are appended to while decoding; an existing file resumes the evaluation', default=None)
+    parser.add_argument('--suffix_workers', help='worker processes that decode whole test cases in parallel on the CPU', type=int, default=1)
+    parser.add_argument('--suffix_threads', help='torch threads per suffix worker, by default the cores are split evenly', type=int, default=None)
+    parser.add_argument('--suffix_samples', help='sampled suffixes per prefix for remaining time quantiles and suffix frequencies, written to a _samples file next to --suffix_results, 0 skips sampling', type=int, default=0)
+    parser.add_argument('--temperature', help='temperature of the activity distribution when sampling suffixes', type=float, default=1.0)
+    parser.add_argument('--top_k', help='sample only among the k most likely activities, 0 samples among all', type=int, default=0)
+    parser.add_argument('--eval_interval', help='evaluate every n training steps', type=int, default=50)
+    parser.add_argument('--eval_batch_size', help='prefixes per evaluation forward pass', type=int, default=4096)
+    parser.add_argument('--precision', help='bfloat16 runs the forward passes of training, evaluation and suffix decoding under bfloat16 autocast, losses and penalties stay float32', choices=['float32', 'bfloat16'], default='float32')
+    parser.add_argument('--quantize', help='report the test metrics and decode suffixes with dynamically int8 quantized copies of the trained models, on the CPU', action='store_true')
+    parser.add_argument('--compile', help='run the training forward pass through torch.compile, falling back to eager execution if compiling fails', action='store_true')
+    parser.add_argument('--hidden_size', help='overrides the LSTM hidden size of the script', type=int, default=None)
+    parser.add_argument('--lr', help='overrides the learning rate of the script', type=float, default=None)
+    parser.add_argument('--penalty_weight', help='overrides the IRM penalty weight of the script', type=float, default=None)
+    parser.add_argument('--l2_weight', help='overrides the L2 weight decay of the script', type=float, default=None)
+    parser.add_argument('--restarts', help='overrides the number of models trained from different initial weights', type=int, default=None)
+    parser.add_argument('--ensemble', help='train all restarts at once as one model with stacked weights, and report their mean and standard deviation', action='store_true')
+    parser.add_argument('--patience', help='stop training once the validation loss has not improved for this many checks and restore the best model, 0 trains for the fixed number of steps', type=int, default=0)
+    parser.add_argument('--validation_fraction', help='share of every training environment, in whole cases, held out for early stopping', type=float, default=0.1)
+    parser.add_argument('--validation_interval', help='check the validation loss every n training steps', type=int, default=10)
+    parser.add_argument('--min_delta', help='smallest decrease of the validation loss that counts as an improvement', type=float, default=0.0)
+    parser.add_argument('--checkpoint', help='file the model, optimizer, scheduler and RNG states are saved to during training', default=None)
+    parser.add_argument('--checkpoint_interval', help='save a checkpoint every n training steps and after the last one', type=int, default=100)
+    parser.add_argument('--resume', help='continue training from --checkpoint if it exists', action='store_true')
+    parser.add_argument('--evaluate_only', help='with --resume, evaluate the checkpointed model without training further', action='store_true')
+    parser.add_argument('--micro_batch_size', help='prefixes per forward and backward pass, the gradients of an environment batch are accumulated over its micro-batches to bound memory, 0 runs every environment batch at once', type=int, default=0)
+    parser.add_argument('--world_size', help='processes that train together, each on its own share of the training environments, with their gradients summed over the gloo backend', type=int, default=1)
+    parser.add_argument('--master_address', help='address the processes of --world_size meet at', default='127.0.0.1')
+    parser.add_argument('--master_port', help='port the processes of --world_size meet at', type=int, default=29500)
+    parser.add_argument('--init_state', help='initial LSTM states: cached zeros or learned', choices=['zeros', 'learned'], default='zeros')
+    parser.add_argument('--architecture', help='two_tower: separate LSTMs per head, shared: one LSTM feeds both heads, shared_adapter: shared LSTM with a small adapter per head', choices=['two_tower', 'shared', 'shared_adapter'], default='two_tower')
+    return parser.parse_args(argv)
+
+def main():
+    launch(run, parse_args())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,590 @@
+import copy
+import os
+import pickle
+from collections import OrderedDict
+from functools import partial
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from precision import autocast
+from quantize import model_device
+
+
+def case_starts(X):
+    # A prefix holding a single activity marks the start of a new case
+    starts = (torch.count_nonzero(X[:, :, 0], dim=1) == 1).cpu().numpy()
+    starts[0] = True
+    return starts
+
+
+def case_positions(X):
+    # Case number and number of events of every prefix
+    starts = case_starts(X)
+    case = np.cumsum(starts) - 1
+    return case, np.arange(len(starts)) - np.flatnonzero(starts)[case] + 1
+
+
+def case_lengths(X):
+    # Number of events left to predict after every prefix
+    starts = case_starts(X)
+    first_rows = np.flatnonzero(starts)
+    case_ends = np.append(first_rows[1:], len(starts))
+    case = np.cumsum(starts) - 1
+    return case_ends[case] - np.arange(len(starts))
+
+
+def damerau_levenshtein_distance(a, b, a_lengths, b_lengths):
+    # Unrestricted Damerau-Levenshtein distance between integer sequences, row by row
+    # for a whole batch of padded pairs at once; padding never reaches a valid cell
+    rows = np.arange(len(a))
+    max_a, max_b = a.shape[1], b.shape[1]
+    d = np.zeros((len(a), max_a + 2, max_b + 2), dtype=np.int64)
+    d[:, 0, :] = max_a + max_b
+    d[:, :, 0] = max_a + max_b
+    d[:, 1:, 1] = np.arange(max_a + 1)
+    d[:, 1, 1:] = np.arange(max_b + 1)
+    # Last row of a in which every activity occurred
+    last_row = np.zeros((len(a), int(max(a.max(initial=0), b.max(initial=0))) + 1), dtype=np.int64)
+    for i in range(1, max_a + 1):
+        # Last column of b that matched a[i]
+        last_col = np.zeros(len(a), dtype=np.int64)
+        for j in range(1, max_b + 1):
+            k = last_row[rows, b[:, j - 1]]
+            l = last_col
+            match = a[:, i - 1] == b[:, j - 1]
+            d[:, i + 1, j + 1] = np.minimum.reduce([
+                d[:, i, j] + ~match,
+                d[:, i + 1, j] + 1,
+                d[:, i, j + 1] + 1,
+                d[rows, k, l] + (i - k - 1) + 1 + (j - l - 1),
+            ])
+            last_col = np.where(match, j, last_col)
+        last_row[rows, a[:, i - 1]] = i
+    return d[rows, a_lengths + 1, b_lengths + 1]
+
+
+def damerau_levenshtein_similarity(a, b, a_lengths, b_lengths):
+    distance = damerau_levenshtein_distance(a, b, a_lengths, b_lengths)
+    # Two empty suffixes are identical
+    return 1 - distance / np.maximum(np.maximum(a_lengths, b_lengths), 1)
+
+
+def next_event(window, activity, time):
+    # The predicted event repeats the case attributes of the last event in the window
+    event = window[:, -1:, :].clone()
+    event[:, 0, 0] = activity
+    event[:, 0, 1] = time
+    return event
+
+
+def narrow_states(states, active):
+    # Keep the LSTM states of the first active rows; cuDNN needs them contiguous
+    return tuple(None if state is None else tuple(s[:, :active].contiguous() for s in state) for state in states)
+
+
+def select_states(states, index):
+    # LSTM states of the given rows, in that order
+    return tuple(None if state is None else tuple(s[:, index] for s in state) for state in states)
+
+
+def decode(model, windows, lengths, incremental=False, end_of_case=None, choose=None):
+    # Greedy decoding of lengths[i] events for every window. Windows come sorted by
+    # descending length, so the rows still decoding always form a leading slice.
+    # Incremental decoding runs the window once and then feeds one event per step,
+    # carrying the LSTM states instead of re-running the slid window.
+    # Nothing leaves the device until the whole batch is decoded, so the loop never
+    # waits on a device synchronization. The exception is decoding up to an
+    # end_of_case class, where lengths are only a cap: rows that predicted the end of
+    # their case are dropped after every step, which needs their count on the host.
+    # choose picks the next activity from the logits, the most likely one by default.
+    steps = int(lengths[0])
+    activities = torch.zeros((len(windows), steps), dtype=torch.long, device=windows.device)
+    times = torch.zeros((len(windows), steps), device=windows.device)
+    rows = torch.arange(len(windows), device=windows.device)
+    inputs = windows
+    states = None
+    for step in range(steps):
+        active = int(np.count_nonzero(lengths > step))
+        if active < len(rows):
+            rows = rows[:active]
+            windows = windows[:active]
+            inputs = inputs[:active]
+            if states is not None:
+                states = narrow_states(states, active)
+        logits, time, states = model.step(inputs, states if incremental else None)
+        preds = torch.argmax(logits, dim=1) if choose is None else choose(logits)
+        activities[rows, step] = preds
+        times[rows, step] = time
+        event = next_event(windows, preds.float(), time)
+        windows = torch.cat((windows[:, 1:, :], event), dim=1)
+        inputs = event if incremental else windows
+
+        if end_of_case is not None:
+            running = torch.nonzero(preds != end_of_case).squeeze(1)
+            if len(running) == 0:
+                break
+            if len(running) < len(rows):
+                rows, windows, inputs = rows[running], windows[running], inputs[running]
+                if incremental:
+                    states = select_states(states, running)
+    return activities.cpu().numpy(), times.cpu().numpy()
+
+
+def beam_decode(model, windows, lengths, incremental=False, beam_width=3, length_penalty=1.0, end_of_case=None):
+    # Beam search version of decode(): every window keeps its beam_width most likely
+    # partial suffixes, and all beams of all windows share one forward per step. A
+    # suffix is scored by its summed log-probability divided by length ** length_penalty.
+    # A beam that predicted end_of_case is finished: it keeps its score and length,
+    # and windows whose beams have all finished are dropped.
+    steps = int(lengths[0])
+    device = windows.device
+    activities = torch.zeros((len(windows), beam_width, steps), dtype=torch.long, device=device)
+    times = torch.zeros((len(windows), beam_width, steps), device=device)
+    # Only the first beam of every window is live until the first expansion
+    scores = torch.full((len(windows), beam_width), float('-inf'), device=device)
+    scores[:, 0] = 0
+    suffix_lengths = torch.zeros((len(windows), beam_width), device=device)
+    finished = torch.zeros((len(windows), beam_width), dtype=torch.bool, device=device)
+    final_scores = scores.clone()
+    final_lengths = suffix_lengths.clone()
+    rows = torch.arange(len(windows), device=device)
+
+    windows = windows.repeat_interleave(beam_width, dim=0)
+    inputs = windows
+    states = None
+    for step in range(steps):
+        active = int(np.count_nonzero(lengths > step))
+        if active < len(rows):
+            rows, scores, suffix_lengths, finished = rows[:active], scores[:active], suffix_lengths[:active], finished[:active]
+            windows = windows[:active * beam_width]
+            inputs = inputs[:active * beam_width]
+            if states is not None:
+                states = narrow_states(states, active * beam_width)
+        logits, time, states = model.step(inputs, states if incremental else None)
+        log_probs = F.log_softmax(logits, dim=1).view(len(rows), beam_width, -1)
+        num_classes = log_probs.shape[2]
+        if end_of_case is not None:
+            # A finished beam can only repeat the end of its case, at no cost
+            ended = torch.full((num_classes,), float('-inf'), device=device)
+            ended[end_of_case] = 0
+            log_probs = torch.where(finished[:, :, None], ended, log_probs)
+        scores, candidates = (scores[:, :, None] + log_probs).view(len(rows), -1).topk(beam_width, dim=1)
+        parents = torch.div(candidates, num_classes, rounding_mode='floor')
+        preds = candidates % num_classes
+
+        # Every surviving beam continues the history of its parent beam
+        history = parents[:, :, None].expand(-1, -1, steps)
+        activities[rows] = activities[rows].gather(1, history)
+        times[rows] = times[rows].gather(1, history)
+        activities[rows, :, step] = preds
+        times[rows, :, step] = time.view(len(rows), beam_width).gather(1, parents)
+        parent_finished = finished.gather(1, parents)
+        suffix_lengths = suffix_lengths.gather(1, parents) + ~parent_finished
+        finished = parent_finished | (preds == end_of_case) if end_of_case is not None else parent_finished
+        final_scores[rows] = scores
+        final_lengths[rows] = suffix_lengths
+
+        index = (parents + torch.arange(len(rows), device=device)[:, None] * beam_width).view(-1)
+        windows = windows[index]
+        if incremental:
+            states = select_states(states, index)
+        event = next_event(windows, preds.view(-1).float(), time[index])
+        windows = torch.cat((windows[:, 1:, :], event), dim=1)
+        inputs = event if incremental else windows
+
+        if end_of_case is not None:
+            running = torch.nonzero(~finished.all(dim=1)).squeeze(1)
+            if len(running) == 0:
+                break
+            if len(running) < len(rows):
+                beams = (running[:, None] * beam_width + torch.arange(beam_width, device=device)).view(-1)
+                rows, scores, suffix_lengths, finished = rows[running], scores[running], suffix_lengths[running], finished[running]
+                windows, inputs = windows[beams], inputs[beams]
+                if incremental:
+                    states = select_states(states, beams)
+
+    best = torch.argmax(final_scores / final_lengths.clamp(min=1) ** length_penalty, dim=1)
+    rows = torch.arange(len(best), device=device)
+    return activities[rows, best].cpu().numpy(), times[rows, best].cpu().numpy()
+
+
+def sampler(temperature=1.0, top_k=0):
+    # Draws the next activity from the softmax of the logits at the given temperature,
+    # among the top_k most likely activities when top_k is set
+    def choose(logits):
+        logits = logits / temperature
+        if top_k > 0:
+            kth = logits.topk(min(top_k, logits.shape[1]), dim=1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+        return torch.multinomial(F.softmax(logits, dim=1), 1).squeeze(1)
+    return choose
+
+
+def sample_decode(model, windows, lengths, samples, incremental=False, end_of_case=None, temperature=1.0, top_k=0):
+    # Monte-Carlo version of decode(): every window is expanded into samples rollouts
+    # that draw their activities, and all rollouts advance in one forward per step
+    activities, times = decode(model, windows.repeat_interleave(samples, dim=0), np.repeat(lengths, samples),
+                               incremental, end_of_case, sampler(temperature, top_k))
+    return activities.reshape(len(windows), samples, -1), times.reshape(len(windows), samples, -1)
+
+
+class SuffixCache:
+    # Greedy and beam decoding are deterministic for models with fixed or learned initial
+    # states, so identical prefix windows get identical suffixes. Entries map the raw bytes of a window to its decoded activities and
+    # per-step times, and are evicted least recently used first. A beam search suffix
+    # cut short is not the best suffix of the shorter length, so with exact_length an
+    # entry is only reused for the length it was decoded for.
+    def __init__(self, max_size, exact_length=False):
+        self.max_size = max_size
+        self.exact_length = exact_length
+        self.entries = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+
+    def get(self, key, length):
+        entry = self.entries.get(key)
+        if entry is None or len(entry[0]) < length:
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, activities, times):
+        entry = self.entries.get(key)
+        if entry is None or len(entry[0]) < len(activities):
+            self.entries[key] = (activities, times)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def cached_decode(decoder, windows, host_windows, lengths, cache):
+    # Only windows missing from the cache are decoded, each distinct one once and as
+    # far as the longest suffix asked of it. Rows come sorted by descending length,
+    # so the first decode of a window normally covers every later repeat.
+    activities = np.zeros((len(windows), int(lengths[0])), dtype=np.int64)
+    times = np.zeros((len(windows), int(lengths[0])), dtype=np.float32)
+    keys = [window.tobytes() + (int(length).to_bytes(4, 'little') if cache.exact_length else b'')
+            for window, length in zip(host_windows, lengths)]
+    misses = OrderedDict()
+    for k, key in enumerate(keys):
+        entry = cache.get(key, lengths[k])
+        if entry is None:
+            misses.setdefault(key, []).append(k)
+        else:
+            activities[k, :lengths[k]] = entry[0][:lengths[k]]
+            times[k, :lengths[k]] = entry[1][:lengths[k]]
+    cache.lookups += len(keys)
+    cache.hits += len(keys) - len(misses)
+
+    if misses:
+        first = np.array([ks[0] for ks in misses.values()])
+        decoded_activities, decoded_times = decoder(windows[torch.as_tensor(first, device=windows.device)],
+                                                    lengths[first])
+        for g, (key, ks) in enumerate(misses.items()):
+            cache.put(key, decoded_activities[g, :lengths[ks[0]]], decoded_times[g, :lengths[ks[0]]])
+            for k in ks:
+                activities[k, :lengths[k]] = decoded_activities[g, :lengths[k]]
+                times[k, :lengths[k]] = decoded_times[g, :lengths[k]]
+    return activities, times
+
+
+def scored_prefixes(X, Y, max_suffix_length, end_of_case=None):
+    # Remaining suffix length, labels and times of every prefix, and the prefixes to
+    # score: those with at most max_suffix_length events left, longest suffixes first
+    # so that rows finishing early drop off the end of their batch.
+    lengths = case_lengths(X)
+    labels = Y[:, 0].cpu().numpy().astype(int)
+    timestamps = Y[:, 1].cpu().numpy().astype(float)
+
+    # With an end-of-case class the last prefix of every case predicts it, so the true
+    # suffix is one event shorter and the decoder itself decides where the case ends
+    if end_of_case is not None:
+        lengths = lengths - 1
+
+    valid = np.flatnonzero(lengths <= max_suffix_length)
+    valid = valid[np.argsort(-lengths[valid], kind='stable')]
+    return lengths, labels, timestamps, valid
+
+
+def true_suffixes(rows, lengths, labels, timestamps):
+    # The true suffix of prefix i is the next lengths[i] rows of Y, padded with zeros
+    offsets = np.arange(lengths[rows].max())
+    in_suffix = offsets < lengths[rows][:, None]
+    following = np.minimum(rows[:, None] + offsets, len(labels) - 1)
+    return np.where(in_suffix, labels[following], 0), np.where(in_suffix, timestamps[following], 0).sum(axis=1)
+
+
+def decoded_lengths(activities, lengths, end_of_case=None):
+    # Decoded suffixes end at the first end-of-case class, or run for their full length
+    if end_of_case is None:
+        return lengths
+    ended = activities == end_of_case
+    return np.where(ended.any(axis=-1), ended.argmax(axis=-1), activities.shape[-1])
+
+
+def remaining_times(times, lengths):
+    predicted = np.arange(times.shape[-1]) < lengths[..., None]
+    return np.where(predicted, times, 0).astype(float).sum(axis=-1)
+
+
+def encode_suffixes(activities, lengths):
+    # Space separated activity codes of every suffix
+    return [' '.join(map(str, suffix[:length])) for suffix, length in zip(activities.tolist(), lengths)]
+
+
+def load_results(results_path):
+    # Rows of an interrupted evaluation. A row cut short by the interruption lacks its
+    # line break and is truncated away before appending resumes.
+    with open(results_path, 'rb+') as results_file:
+        complete = results_file.read().rfind(b'\n') + 1
+        results_file.truncate(complete)
+    if complete == 0:
+        return None
+    return pd.read_csv(results_path, keep_default_na=False)
+
+
+class SuffixScorer:
+    # Decodes the suffixes of batches of test prefixes and scores them against the true
+    # ones. Worker processes of a parallel evaluation each build their own.
+    def __init__(self, model, X, Y, max_suffix_length, incremental=False, cache_size=0, beam_width=1,
+                 length_penalty=1.0, end_of_case=None, length_cap=50, precision='float32'):
+        self.X = X
+        self.precision = precision
+        self.device = model_device(model)
+        self.lengths, self.labels, self.timestamps, self.valid = scored_prefixes(X, Y, max_suffix_length, end_of_case)
+        self.end_of_case = end_of_case
+        self.length_cap = length_cap
+        if beam_width > 1:
+            self.decoder = partial(beam_decode, model, incremental=incremental, beam_width=beam_width,
+                                   length_penalty=length_penalty, end_of_case=end_of_case)
+        else:
+            self.decoder = partial(decode, model, incremental=incremental, end_of_case=end_of_case)
+        self.cache = SuffixCache(cache_size, exact_length=beam_width > 1) if cache_size > 0 else None
+        self.host_X = X.cpu().numpy() if self.cache is not None else None
+
+    def score(self, rows):
+        # rows must come sorted by descending suffix length
+        windows = self.X[torch.as_tensor(rows)].to(self.device)
+        number_to_predict = self.lengths[rows]
+        decode_lengths = number_to_predict if self.end_of_case is None else np.full(len(rows), self.length_cap)
+        with autocast(self.device, self.precision):
+            if self.cache is None:
+                activities, times = self.decoder(windows, decode_lengths)
+                cache_hits = cache_lookups = 0
+            else:
+                hits, lookups = self.cache.hits, self.cache.lookups
+                activities, times = cached_decode(self.decoder, windows, self.host_X[rows], decode_lengths, self.cache)
+                cache_hits, cache_lookups = self.cache.hits - hits, self.cache.lookups - lookups
+        predicted_lengths = decoded_lengths(activities, number_to_predict, self.end_of_case)
+        ground_truth_labels, ground_truth_times = true_suffixes(rows, self.lengths, self.labels, self.timestamps)
+        return {
+            'rows': rows,
+            'activities': activities,
+            'predicted_lengths': predicted_lengths,
+            'times': remaining_times(times, predicted_lengths),
+            'ground_truth_labels': ground_truth_labels,
+            'number_to_predict': number_to_predict,
+            'ground_truth_times': ground_truth_times,
+            'similarity': damerau_levenshtein_similarity(activities, ground_truth_labels, predicted_lengths,
+                                                         number_to_predict),
+            'cache_hits': cache_hits,
+            'cache_lookups': cache_lookups,
+        }
+
+
+def case_chunks(rows, cases, lengths, size):
+    # Splits prefixes into chunks of whole cases holding about size prefixes each,
+    # every chunk sorted by descending suffix length for the decoder
+    rows = rows[np.argsort(cases[rows], kind='stable')]
+    chunks = []
+    start = 0
+    for boundary in np.append(np.flatnonzero(np.diff(cases[rows])) + 1, len(rows)):
+        if boundary - start >= size or (boundary == len(rows) and boundary > start):
+            chunk = rows[start:boundary]
+            chunks.append(chunk[np.argsort(-lengths[chunk], kind='stable')])
+            start = boundary
+    return chunks
+
+
+worker_scorer = None
+
+
+def init_worker(model, X, Y, max_suffix_length, options, threads):
+    global worker_scorer
+    torch.set_num_threads(threads)
+    model = pickle.loads(model)
+    model.eval()
+    worker_scorer = SuffixScorer(model, X, Y, max_suffix_length, **options)
+
+
+def score_in_worker(rows):
+    with torch.no_grad():
+        return worker_scorer.score(rows)
+
+
+def suffix_prediction(model, X, Y, max_suffix_length, batch_size=1024, incremental=False, cache_size=0,
+                      beam_width=1, length_penalty=1.0, end_of_case=None, length_cap=50, results_path=None,
+                      workers=1, threads_per_worker=None, precision='float32'):
+    # With a results_path every scored prefix is appended to that CSV as soon as its
+    # batch is decoded. Prefixes already in the file are not decoded again, so an
+    # interrupted evaluation resumes where it stopped.
+    # With several workers the prefixes are split into chunks of whole cases, decoded
+    # on the CPU by worker processes that each hold a copy of the model and use
+    # threads_per_worker threads (the cores split evenly by default). Their DL and MAE
+    # sums are merged before averaging.
+    # precision='bfloat16' decodes with the model's forward passes autocast to bfloat16.
+    if model.init_state == 'xavier':
+        # Initial states re-drawn on every forward decode a window differently every
+        # time, a cached suffix would change the scores
+        cache_size = 0
+    options = dict(incremental=incremental, cache_size=cache_size, beam_width=beam_width,
+                   length_penalty=length_penalty, end_of_case=end_of_case, length_cap=length_cap,
+                   precision=precision)
+    was_training = model.training
+    model.eval()
+    scorer = SuffixScorer(model, X, Y, max_suffix_length, **options)
+    valid = scorer.valid
+    scored = len(valid)
+
+    total_dl_distance = 0.0
+    total_time_mae = 0.0
+    results_file = None
+    if results_path is not None:
+        results = load_results(results_path) if os.path.exists(results_path) else None
+        if results is not None:
+            total_dl_distance = results['similarity'].sum()
+            total_time_mae = (results['predicted_time'] - results['true_time']).abs().sum()
+            valid = valid[~np.isin(valid, results['row'].to_numpy())]
+            print("Resuming suffix prediction,", len(results), "prefixes already scored")
+        results_file = open(results_path, 'a', newline='')
+    cases, positions = case_positions(X)
+
+    pool = None
+    if workers > 1:
+        threads = threads_per_worker or max(torch.get_num_threads() // workers, 1)
+        chunks = case_chunks(valid, cases, scorer.lengths, batch_size)
+        # The model is pickled up front: quantized layers create their weight tensors
+        # while being pickled, and those do not outlive the shared memory handoff of
+        # tensors to the spawned workers
+        pool = torch.multiprocessing.get_context('spawn').Pool(
+            workers, init_worker, (pickle.dumps(copy.deepcopy(model).cpu()), X.cpu(), Y.cpu(), max_suffix_length, options, threads))
+        batches = pool.imap_unordered(score_in_worker, chunks)
+    else:
+        chunks = range(0, len(valid), batch_size)
+        batches = (scorer.score(valid[start:start + batch_size]) for start in chunks)
+
+    cache_hits = 0
+    cache_lookups = 0
+    try:
+        with torch.no_grad():
+            for batch in tqdm(batches, total=len(chunks), desc="suffix prediction"):
+                total_dl_distance = total_dl_distance + batch['similarity'].sum()
+                total_time_mae = total_time_mae + np.abs(batch['times'] - batch['ground_truth_times']).sum()
+                cache_hits = cache_hits + batch['cache_hits']
+                cache_lookups = cache_lookups + batch['cache_lookups']
+
+                if results_file is not None:
+                    rows = batch['rows']
+                    pd.DataFrame({
+                        'row': rows,
+                        'case': cases[rows],
+                        'position': positions[rows],
+                        'predicted_suffix': encode_suffixes(batch['activities'], batch['predicted_lengths']),
+                        'predicted_time': batch['times'],
+                        'true_suffix': encode_suffixes(batch['ground_truth_labels'], batch['number_to_predict']),
+                        'true_time': batch['ground_truth_times'],
+                        'similarity': batch['similarity'],
+                    }).to_csv(results_file, header=results_file.tell() == 0, index=False)
+                    results_file.flush()
+    finally:
+        if pool is not None:
+            # Idle once every chunk is scored, otherwise a worker failed or the
+            # evaluation was interrupted and they are stopped mid-chunk
+            pool.terminate()
+            pool.join()
+        model.train(was_training)
+        if results_file is not None:
+            results_file.close()
+
+    total_dl_distance = total_dl_distance / scored
+    total_time_mae = total_time_mae / scored
+    print("DL Distance")
+    print(total_dl_distance)
+    print("Timestamp MAE")
+    print(total_time_mae)
+    if cache_size > 0:
+        print("Suffix cache hit rate")
+        print(cache_hits / max(cache_lookups, 1), "of", cache_lookups, "prefixes")
+    return total_dl_distance, total_time_mae
+
+
+def suffix_sampling(model, X, Y, max_suffix_length, samples=100, batch_size=1024, incremental=False, temperature=1.0,
+                    top_k=0, end_of_case=None, length_cap=50, quantiles=(0.1, 0.5, 0.9), precision='float32',
+                    results_path=None):
+    # Samples rollouts for every scored prefix and summarizes them as quantiles of the
+    # remaining time and the share of every distinct sampled suffix. batch_size counts
+    # rollouts, so a batch holds batch_size // samples prefixes.
+    # With a results_path the summaries of every prefix are written to that CSV.
+    device = model_device(model)
+    lengths, labels, timestamps, valid = scored_prefixes(X, Y, max_suffix_length, end_of_case)
+    prefixes_per_batch = max(batch_size // samples, 1)
+
+    time_quantiles = np.zeros((len(valid), len(quantiles)))
+    sequence_frequencies = []
+    total_covered = 0
+    total_most_frequent = 0
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        for start in tqdm(range(0, len(valid), prefixes_per_batch), desc="suffix sampling"):
+            rows = valid[start:start + prefixes_per_batch]
+            windows = X[torch.as_tensor(rows)].to(device)
+            number_to_predict = lengths[rows]
+            decode_lengths = number_to_predict if end_of_case is None else np.full(len(rows), length_cap)
+            with autocast(device, precision):
+                activities, times = sample_decode(model, windows, decode_lengths, samples, incremental, end_of_case,
+                                                  temperature, top_k)
+            predicted_lengths = decoded_lengths(activities, np.repeat(number_to_predict[:, None], samples, axis=1),
+                                                end_of_case)
+            batch_quantiles = np.quantile(remaining_times(times, predicted_lengths), quantiles, axis=1).T
+            time_quantiles[start:start + len(rows)] = batch_quantiles
+            ground_truth_labels, ground_truth_times = true_suffixes(rows, lengths, labels, timestamps)
+            total_covered = total_covered + np.count_nonzero((ground_truth_times >= batch_quantiles[:, 0]) &
+                                                             (ground_truth_times <= batch_quantiles[:, -1]))
+
+            for k in range(len(rows)):
+                # Mark everything after the end of a suffix so that equal suffixes compare equal
+                sequences = np.where(np.arange(activities.shape[2]) < predicted_lengths[k][:, None], activities[k], -1)
+                unique, counts = np.unique(sequences, axis=0, return_counts=True)
+                frequencies = {tuple(s[s >= 0].tolist()): count / samples for s, count in zip(unique, counts)}
+                sequence_frequencies.append(frequencies)
+                most_frequent = max(frequencies, key=frequencies.get)
+                total_most_frequent = total_most_frequent + (most_frequent == tuple(ground_truth_labels[k, :number_to_predict[k]].tolist()))
+    model.train(was_training)
+
+    if results_path is not None:
+        cases, positions = case_positions(X)
+        ground_truth_labels, ground_truth_times = true_suffixes(valid, lengths, labels, timestamps)
+        summaries = pd.DataFrame({
+            'row': valid,
+            'case': cases[valid],
+            'position': positions[valid],
+            'true_suffix': encode_suffixes(ground_truth_labels, lengths[valid]),
+            'true_time': ground_truth_times,
+        })
+        for k, quantile in enumerate(quantiles):
+            summaries['time_q%g' % quantile] = time_quantiles[:, k]
+        # Sampled suffixes with their share, most frequent first: "1 2 3:0.45;1 2:0.3"
+        summaries['suffix_frequencies'] = [
+            ';'.join('%s:%g' % (' '.join(map(str, suffix)), share)
+                     for suffix, share in sorted(frequencies.items(), key=lambda item: -item[1]))
+            for frequencies in sequence_frequencies]
+        summaries.to_csv(results_path, index=False)
+
+    print("Remaining time coverage between the", quantiles[0], "and", quantiles[-1], "quantiles")
+    print(total_covered / len(valid))
+    print("Most frequent sampled suffix accuracy")
+    print(total_most_frequent / len(valid))
+    return valid, time_quantiles, sequence_frequencies
@@ -3,145 +3,142 @@ import numpy as np
 import torch
 from torch import nn, optim, autograd
 import pandas as pd
+import os
 from numpy import vstack, argmax
 from sklearn.metrics import accuracy_score
-from jellyfish._jellyfish import damerau_levenshtein_distance
 import copy
 from nltk.util import ngrams
 pd.options.mode.chained_assignment = None  # default='warn'
 import torchvision.transforms as transforms
 from tqdm import tqdm
+from suffix import suffix_prediction, suffix_sampling
+from checkpoint import save_checkpoint, load_checkpoint, restore_checkpoint
+from early_stopping import EarlyStopping, validation_split, validation_loss
+from data_cache import read_csv_array
+from ensemble import Ensemble
+from precision import autocast
+from compiled import Compiled
+from quantize import quantize_model, model_device, model_bytes
 import math
+from time import perf_counter
 import random
 
 random.seed(20)
 
-def suffix_prediction(model, X_test, Y_test, X_train, Y_train, generalized_data):
-    l1_loss = nn.L1Loss()
-
-    case_length = []
-    current_case_length = 1
-
-    for i in tqdm(range(1, X_test.shape[0]), desc = "finding case lengths"):
-        current_case = X_test[i, :, 0]
-        temp = torch.count_nonzero(current_case).detach().cpu().numpy()
-        if temp == 1:
-            current_case_length = list(range(current_case_length, 0, -1))
-            case_length.extend(current_case_length)
-            current_case_length = 1
-        else:
-            current_case_length += 1
-    
-    current_case_length = list(range(current_case_length, 0, -1))
-    case_length.extend(current_case_length)
-    total_dl_distance = 0.0
-    total_time_mae = 0.0
-    count = 0
-    valid_case_count = 0
-    for i in tqdm(range(0, X_test.shape[0]), desc="suffix prediction"):
-        current_case = X_test[i, :, :]
-        current_case = current_case.unsqueeze_(0)
-        
-        predicted_case = current_case
-
-        number_to_predict = case_length[i]
-        if number_to_predict > 5:
-            continue
-        valid_case_count += 1
-        ground_truth_labels = Y_test[i:(i+number_to_predict), 0].detach().cpu().numpy().tolist()
-        ground_truth_labels = [int(i) for i in ground_truth_labels]
-
-        ground_truth_labels = map(str, ground_truth_labels)    
-        ground_truth_labels = ''.join(ground_truth_labels)      
-
-        ground_truth_timestamps = torch.sum(Y_test[i:(i+number_to_predict), 1])
-
-        case_labels = []
-        case_time_acc = torch.zeros(1).cuda()
-
-        for j in range(0, number_to_predict):
-            logits, time = model(predicted_case)
-            preds = torch.argmax(logits, dim=1)[0].float()
-
-            resource = predicted_case[0, -1, 2]
-            variant = predicted_case[0, -1, 3]
-
-            if generalized_data:
-                generalization = predicted_case[0, -1, 4]
-                predicted_row = torch.tensor([preds, time, resource, variant, generalization]).cuda()
-            else:
-                predicted_row = torch.tensor([preds, time, resource, variant]).cuda()
-
-            if (j+1) != number_to_predict:
-                if current_case.shape[0] <= 2:
-                    break
-                predicted_case[0, -(j+2), :] = predicted_case[0, -(j+1), :]
-                predicted_case[0, -(j+1), :] = predicted_row
-
-            preds = preds.detach().cpu().numpy().tolist()
-            case_labels.append(preds)
-            case_time_acc = case_time_acc + time[0]
-        
-        case_labels = [int(i) for i in case_labels]
-        case_labels = map(str, case_labels)    
-        case_labels = ''.join(case_labels)    
-        
-        dist = 1 - (damerau_levenshtein_distance(case_labels, ground_truth_labels) /
-                         max((len(case_labels), len(ground_truth_labels))))
-        total_dl_distance = total_dl_distance + dist
-        total_time_mae = total_time_mae + l1_loss(case_time_acc[0], ground_truth_timestamps).detach().cpu().numpy()
-    
-    total_dl_distance = total_dl_distance / valid_case_count
-    total_time_mae = total_time_mae / valid_case_count
-    print("DL Distance")
-    print(total_dl_distance)
-    print("Timestamp MAE")
-    print(total_time_mae)
-
 class RNN(nn.Module):
-    def __init__(self, total_size, input_size, embedding_size, hidden_size, num_layers, num_classes):
+    def __init__(self, vocabulary_size, input_size, embedding_size, hidden_size, num_layers, num_classes, init_state='xavier', architecture='two_tower'):
         super(RNN, self).__init__()
-        self.embedding = nn.Embedding(total_size, embedding_size)
+        self.embedding = nn.Embedding(vocabulary_size, embedding_size)
         self.hidden_size = hidden_size
         self.num_layers = num_layers
+        self.architecture = architecture
         self.lstm = nn.LSTM(input_size + embedding_size - 1, hidden_size, num_layers, dropout = 0.2, batch_first=True)
-        self.lstm_timestamp = nn.LSTM(input_size + embedding_size - 1, hidden_size, num_layers, dropout = 0.2, batch_first=True)
+        if architecture == 'two_tower':
+            self.lstm_timestamp = nn.LSTM(input_size + embedding_size - 1, hidden_size, num_layers, dropout = 0.2, batch_first=True)
         self.fc = nn.Linear(hidden_size, num_classes)
         self.fc_timestamp = nn.Linear(hidden_size, 1)
+        if architecture == 'shared_adapter':
+            self.adapter = nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.ReLU())
+            self.adapter_timestamp = nn.Sequential(nn.Linear(hidden_size, hidden_size), nn.ReLU())
+        self.init_state = init_state
+        if init_state == 'learned':
+            self.h0 = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+            self.c0 = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+            if architecture == 'two_tower':
+                self.ht = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+                self.ct = nn.Parameter(torch.zeros(num_layers, 1, hidden_size))
+        self._zero_states = {}
+
+    def initial_states(self, x):
+        batch_size = x.size(0)
+        if self.init_state == 'learned':
+            learned = (self.h0, self.c0, self.ht, self.ct) if self.architecture == 'two_tower' else (self.h0, self.c0) * 2
+            states = [state.expand(-1, batch_size, -1) for state in learned]
+            if x.is_cuda:
+                # cuDNN rejects strided hidden states
+                states = [state.contiguous() for state in states]
+            return states
+        if self.init_state == 'xavier':
+            states = [torch.zeros(self.num_layers, batch_size, self.hidden_size, device=x.device) for _ in range(4)]
+            for state in states:
+                torch.nn.init.xavier_uniform_(state)
+            return states
+        # The LSTMs never write to their initial states, so one zero tensor per batch shape is reused
+        key = (batch_size, x.device)
+        if key not in self._zero_states:
+            if len(self._zero_states) >= 16:
+                self._zero_states.clear()
+            self._zero_states[key] = torch.zeros(self.num_layers, batch_size, self.hidden_size, device=x.device)
+        zeros = self._zero_states[key]
+        return [zeros] * 4
     
     def forward(self, x):
-        temp = x[:,:,0]
-        # Set initial hidden and cell states
-        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
-        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
-
-        ht = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
-        ct = torch.zeros(self.num_layers, x.size(0), self.hidden_size).cuda()
-
-        torch.nn.init.xavier_uniform_(h0)
-        torch.nn.init.xavier_uniform_(c0)
+        out, out_timestamp, _ = self.step(x)
+        return out, out_timestamp
 
-        torch.nn.init.xavier_uniform_(ht)
-        torch.nn.init.xavier_uniform_(ct)
+    def step(self, x, states=None):
+        # Like forward, but the LSTMs start from states, the (h, c) pairs returned by an
+        # earlier call, so a decoder can feed only the newest event instead of the window
+        temp = x[:,:,0]
+        if states is None:
+            # Set initial hidden and cell states
+            h0, c0, ht, ct = self.initial_states(x)
+            states = ((h0, c0), (ht, ct))
         
         embeds = self.embedding(temp.long())
 
         embeds = torch.cat((embeds, x[:,:,1:]), dim=2)
 
         # Forward propagate LSTM
-        out, _ = self.lstm(embeds,(h0,c0))  # out: tensor of shape (batch_size, seq_length, hidden_size)
-        out_timestamp, _ = self.lstm_timestamp(embeds,(ht,ct))  # out: tensor of shape (batch_size, seq_length, hidden_size)
-        
+        out, state = self.lstm(embeds, states[0])  # out: tensor of shape (batch_size, seq_length, hidden_size)
+        if self.architecture == 'two_tower':
+            out_timestamp, state_timestamp = self.lstm_timestamp(embeds, states[1])  # out: tensor of shape (batch_size, seq_length, hidden_size)
+        else:
+            out_timestamp, state_timestamp = out, None
+
         # Decode the hidden state of the last time step
-        out = self.fc(out[:, -1, :])
-        out_timestamp = self.fc_timestamp(out_timestamp[:, -1, :])
+        out = out[:, -1, :]
+        out_timestamp = out_timestamp[:, -1, :]
+        if self.architecture == 'shared_adapter':
+            out = self.adapter(out)
+            out_timestamp = self.adapter_timestamp(out_timestamp)
+        out = self.fc(out)
+        out_timestamp = self.fc_timestamp(out_timestamp)
         out_timestamp = torch.flatten(out_timestamp)
-        return out, out_timestamp
+        # float32 predictions also under bfloat16 autocast
+        return out.float(), out_timestamp.float(), (state, state_timestamp)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older models sized the embedding by the number of training prefixes, of which
+        # only the first vocabulary_size rows were ever looked up
+        key = prefix + 'embedding.weight'
+        if key in state_dict and state_dict[key].shape[0] > self.embedding.num_embeddings:
+            state_dict[key] = state_dict[key][:self.embedding.num_embeddings]
+        super(RNN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 def mean_accuracy(logits, y):
     preds = torch.argmax(logits, dim=1).float()
     return (preds == y).float().mean()
 
+def evaluate(model, X, Y, batch_size, precision='float32'):
+    # Deterministic pass over the whole environment, chunked to bound memory
+    device = model_device(model)
+    # An ensemble predicts for every member in turn, its scores are the members' mean
+    members = getattr(model, 'members', 1)
+    model.eval()
+    correct = torch.zeros((), device=device)
+    abs_error = torch.zeros((), device=device)
+    with torch.no_grad():
+        for start in range(0, len(X), batch_size):
+            X_batch = X[start:start + batch_size].to(device)
+            Y_batch = Y[start:start + batch_size].to(device).repeat(members, 1)
+            with autocast(device, precision):
+                logits, time = model(X_batch)
+            correct += (torch.argmax(logits, dim=1).float() == Y_batch[:,0]).sum()
+            abs_error += torch.abs(time - Y_batch[:,1]).sum()
+    model.train()
+    return (correct / (len(X) * members)).cpu().numpy(), (abs_error / (len(X) * members)).cpu().numpy()
+
 def pretty_print(*values):
     col_width = 20
 
@@ -153,27 +150,49 @@ def pretty_print(*values):
     str_values = [format_val(v) for v in values]
     print("   ".join(str_values))
 
-def run(data, suffix):
+def load_vocabulary_size(path, *activity_columns):
+    # Activity codes run from 1 to n with 0 as padding, so the embedding needs n + 1 rows
+    if os.path.exists(path):
+        return len(pd.read_csv(path)) + 1
+    # Data preprocessed before the vocabulary was persisted: fall back to the largest code
+    return max(int(column.max()) for column in activity_columns) + 1
+
+def load_end_of_case(path, *label_columns):
+    # The preprocessors code the end-of-case activity after every activity and list it
+    # in the vocabulary
+    if os.path.exists(path):
+        vocabulary = pd.read_csv(path)
+        codes = vocabulary.loc[vocabulary['activity'] == 'end of case', 'code']
+        if codes.empty:
+            raise ValueError('no end of case activity in ' + path)
+        return int(codes.iloc[0])
+    # Data preprocessed before the vocabulary was persisted: fall back to the largest code
+    return max(int(column.max()) for column in label_columns)
+
+def run(args):
     # Device
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     sequence_length = 10
 
-    if data == 'orig':
-        env1_X = pd.read_csv('../data/BPI13_env1_X.csv').to_numpy()
-        env1_Y = pd.read_csv('../data/BPI13_env1_Y.csv').to_numpy()
-        env2_X = pd.read_csv('../data/BPI13_env2_X.csv').to_numpy()
-        env2_Y = pd.read_csv('../data/BPI13_env2_Y.csv').to_numpy()
-        env3_X = pd.read_csv('../data/BPI13_env3_X.csv').to_numpy()
-        env3_Y = pd.read_csv('../data/BPI13_env3_Y.csv').to_numpy()
+    eoc = 'eoc_' if args.end_of_case else ''
+    if args.data == 'orig':
+        vocabulary_path = f'../data/BPI13_{eoc}activities.csv'
+        env1_X = read_csv_array(f'../data/BPI13_{eoc}env1_X.csv')
+        env1_Y = read_csv_array(f'../data/BPI13_{eoc}env1_Y.csv')
+        env2_X = read_csv_array(f'../data/BPI13_{eoc}env2_X.csv')
+        env2_Y = read_csv_array(f'../data/BPI13_{eoc}env2_Y.csv')
+        env3_X = read_csv_array(f'../data/BPI13_{eoc}env3_X.csv')
+        env3_Y = read_csv_array(f'../data/BPI13_{eoc}env3_Y.csv')
     
-    if data == 'gen':
-        env1_X = pd.read_csv('../data/BPI13_gen_env1_X.csv').to_numpy()
-        env1_Y = pd.read_csv('../data/BPI13_gen_env1_Y.csv').to_numpy()
-        env2_X = pd.read_csv('../data/BPI13_gen_env2_X.csv').to_numpy()
-        env2_Y = pd.read_csv('../data/BPI13_gen_env2_Y.csv').to_numpy()
-        env3_X = pd.read_csv('../data/BPI13_gen_env3_X.csv').to_numpy()
-        env3_Y = pd.read_csv('../data/BPI13_gen_env3_Y.csv').to_numpy()
+    if args.data == 'gen':
+        vocabulary_path = f'../data/BPI13_gen_{eoc}activities.csv'
+        env1_X = read_csv_array(f'../data/BPI13_gen_{eoc}env1_X.csv')
+        env1_Y = read_csv_array(f'../data/BPI13_gen_{eoc}env1_Y.csv')
+        env2_X = read_csv_array(f'../data/BPI13_gen_{eoc}env2_X.csv')
+        env2_Y = read_csv_array(f'../data/BPI13_gen_{eoc}env2_Y.csv')
+        env3_X = read_csv_array(f'../data/BPI13_gen_{eoc}env3_X.csv')
+        env3_Y = read_csv_array(f'../data/BPI13_gen_{eoc}env3_Y.csv')
     
     number_of_features = env1_X.shape[1]
     # Reshape into Number of sequences * length of each sequence (Ngram) * Number of features for each tuple
@@ -186,45 +205,104 @@ def run(data, suffix):
     X_test = env3_X
     Y_test = env3_Y
 
-    X_train = torch.Tensor(X_train).cuda()
-    Y_train = torch.Tensor(Y_train).cuda()
-    X_test = torch.Tensor(X_test).cuda()
-    Y_test = torch.Tensor(Y_test).cuda()
+    X_train = torch.Tensor(X_train).to(device)
+    Y_train = torch.Tensor(Y_train).to(device)
+    X_test = torch.Tensor(X_test).to(device)
+    Y_test = torch.Tensor(Y_test).to(device)
+    env1_X = torch.Tensor(env1_X)
+    env1_Y = torch.Tensor(env1_Y)
+    env2_X = torch.Tensor(env2_X)
+    env2_Y = torch.Tensor(env2_Y)
+
+    X_fit, Y_fit = X_train, Y_train
+    validation_X = validation_Y = None
+    if args.patience > 0:
+        # Hold out the last cases of every training environment
+        env1_X, env1_Y, env1_validation_X, env1_validation_Y = validation_split(env1_X, env1_Y, args.validation_fraction)
+        env2_X, env2_Y, env2_validation_X, env2_validation_Y = validation_split(env2_X, env2_Y, args.validation_fraction)
+        validation_X = torch.cat((env1_validation_X, env2_validation_X))
+        validation_Y = torch.cat((env1_validation_Y, env2_validation_Y))
+        X_fit = torch.cat((env1_X, env2_X)).to(X_train.device)
+        Y_fit = torch.cat((env1_Y, env2_Y)).to(Y_train.device)
+
+    environments = [('env1', env1_X, env1_Y), ('env2', env2_X, env2_Y), ('test', X_test, Y_test)]
+    if validation_X is not None:
+        environments.append(('validation', validation_X, validation_Y))
 
-    total_size = X_train.shape[0]
     input_size = number_of_features
-    hidden_size = 100
+    hidden_size = 100 if args.hidden_size is None else args.hidden_size
     num_layers = 2
     num_classes = 8
+    if args.end_of_case:
+        end_of_case = load_end_of_case(vocabulary_path, Y_train[:,0], Y_test[:,0])
+        num_classes = max(num_classes, end_of_case + 1)
+    else:
+        end_of_case = None
     steps = 501
-    lr = 0.05
-    n_restarts = 1
+    lr = 0.05 if args.lr is None else args.lr
+    n_restarts = 1 if args.restarts is None else args.restarts
+    members = n_restarts if args.ensemble else 1
     embedding_size = math.ceil(num_classes ** 0.25)
+    vocabulary_size = max(load_vocabulary_size(vocabulary_path, X_train[:,:,0], Y_train[:,0], X_test[:,:,0], Y_test[:,0]), num_classes)
     l1_loss = nn.L1Loss()
 
-    for restart in range(n_restarts):
+    results = None
+    checkpoint = None
+    if args.resume and args.checkpoint is not None and os.path.exists(args.checkpoint):
+        checkpoint = load_checkpoint(args.checkpoint)
+
+    for restart in range(0, n_restarts, members):
+        if checkpoint is not None and checkpoint['restart'] > restart:
+            continue
+        if args.evaluate_only and (checkpoint is None or checkpoint['restart'] != restart):
+            # Only the checkpointed restart has trained weights, the others would be
+            # evaluated untrained
+            continue
         print("Restart ", restart)
-        pretty_print('step', 'Next Activity Acc', 'Timestamp Acc')
+        pretty_print('step', 'environment', 'Next Activity Acc', 'Timestamp Acc')
         
-        model = RNN(total_size, input_size, embedding_size, hidden_size, num_layers, num_classes).to(device)
+        models = [RNN(vocabulary_size, input_size, embedding_size, hidden_size, num_layers, num_classes, args.init_state, args.architecture) for _ in range(members)]
+        model = (Ensemble(models) if args.ensemble else models[0]).to(device)
 
         optimizer = torch.optim.Adam(model.parameters(), lr=lr, betas=(0.9,0.999), amsgrad=False)
         lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience = 10, factor = 0.5, threshold=0.0001, min_lr = 0, cooldown=10)
 
-        # Train the model
-        for step in range(steps):
-            X = X_train
-            Y = Y_train
-            X,Y = X.cuda(), Y.cuda()
-            logits, time = model(X)
+        early_stopping = EarlyStopping(args.patience, args.min_delta) if args.patience > 0 else None
+
+        first_step = 0
+        if checkpoint is not None and checkpoint['restart'] == restart:
+            first_step = restore_checkpoint(checkpoint, model, optimizer, lr_scheduler, early_stopping)
+            print("Resuming from step", first_step)
+        last_step = first_step if args.evaluate_only else steps
 
-            labels = Y[:,0].type(torch.LongTensor).cuda()
+        def training_loss(X, Y):
+            with autocast(device, args.precision):
+                logits, time = model(X)
+
+            labels = Y[:,0].type(torch.LongTensor).to(device)
             loss = torch.nn.functional.cross_entropy(logits, labels)
 
-            time_labels = Y[:,1].type(torch.LongTensor).cuda()
+            time_labels = Y[:,1].type(torch.LongTensor).to(device)
             time_loss = l1_loss(time, time_labels)
+            return loss + time_loss
+        if args.compile:
+            # The forward pass and the losses as one compiled graph
+            training_loss = Compiled(training_loss, 'training loss')
 
-            loss = loss + time_loss
+        first_step_seconds = None
+        start = perf_counter()
+        # Train the model
+        for step in range(first_step, last_step):
+            if step == first_step + 1:
+                # The first step, which compiles with --compile, is timed on its own
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                first_step_seconds = perf_counter() - start
+                start = perf_counter()
+            X = X_fit
+            Y = Y_fit
+            X,Y = X.to(device), Y.to(device).repeat(members, 1)
+            loss = training_loss(X, Y)
             
             optimizer.zero_grad()
             loss.backward()
@@ -232,34 +310,130 @@ def run(data, suffix):
             lr_scheduler.step(loss)
 
             
-            with torch.no_grad():
-                X = X_test
-                Y = Y_test
-                X, Y = X.cuda(), Y.cuda()
-                logits, time = model(X)
-                test_acc = mean_accuracy(logits, Y[:,0])
-                time_test_acc = l1_loss(time, Y[:,1])
-                del logits
-
-            if step % 50 == 0:
-                pretty_print(
-                    np.int32(step),
-                    test_acc.detach().cpu().numpy(),
-                    time_test_acc.detach().cpu().numpy(),
-                )
-
-        if suffix == 'True':
-            if data == 'orig':
-                suffix_prediction(model, X_test, Y_test, X_train,Y_train, False)
-            if data == 'gen':
-                    suffix_prediction(model, X_test, Y_test, X_train,Y_train, True)
+            if step % args.eval_interval == 0:
+                for name, env_X, env_Y in environments:
+                    acc, mae = evaluate(model, env_X, env_Y, args.eval_batch_size, args.precision)
+                    pretty_print(np.int32(step), name, acc, mae)
+
+            if early_stopping is not None and (step + 1) % args.validation_interval == 0:
+                loss = validation_loss(model, validation_X, validation_Y, args.eval_batch_size, args.precision)
+                if early_stopping.step(model, loss, step + 1):
+                    print("Early stopping at step", step + 1, "best validation loss", early_stopping.best_loss, "at step", early_stopping.best_step)
+                    last_step = step + 1
+                    break
 
-def main():
+            if args.checkpoint is not None and ((step + 1) % args.checkpoint_interval == 0 or step + 1 == steps):
+                save_checkpoint(args.checkpoint, model, optimizer, lr_scheduler, early_stopping, step=step + 1, restart=restart)
+
+        if early_stopping is not None and last_step > first_step:
+            early_stopping.restore(model)
+            if args.checkpoint is not None:
+                # The restored model finishes the run, resuming does not train it further
+                save_checkpoint(args.checkpoint, model, optimizer, lr_scheduler, early_stopping, step=steps, restart=restart)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        seconds_per_step = (perf_counter() - start) / max(last_step - first_step - (first_step_seconds is not None), 1)
+        test_acc, test_mae = evaluate(model, X_test, Y_test, args.eval_batch_size, args.precision)
+        if last_step > first_step:
+            print('Seconds per step', seconds_per_step, 'first step', first_step_seconds)
+        results = {
+            'parameters': sum(p.numel() for p in model.parameters()) // members,
+            'seconds_per_step': seconds_per_step,
+            'first_step_seconds': first_step_seconds,
+            'test_acc': test_acc,
+            'test_mae': test_mae,
+        }
+
+        trained = model.unstack() if args.ensemble else [model]
+        if args.quantize:
+            # Test metrics and suffix decoding of int8 copies of the trained models
+            trained = [quantize_model(member) for member in trained]
+            results['test_acc'], results['test_mae'] = np.array([evaluate(member, X_test, Y_test, args.eval_batch_size) for member in trained], dtype=float).mean(axis=0)
+        results['model_bytes'] = model_bytes(trained[0])
+        if args.evaluate_only:
+            # No training step reports the checkpointed model's test metrics
+            pretty_print(np.int32(first_step), 'test', np.float64(results['test_acc']), np.float64(results['test_mae']))
+        if args.ensemble:
+            member_results = np.array([evaluate(member, X_test, Y_test, args.eval_batch_size, args.precision) for member in trained], dtype=float)
+            pretty_print('restarts', 'Next Activity Acc', 'Timestamp Acc')
+            pretty_print('mean', *member_results.mean(axis=0))
+            pretty_print('std', *member_results.std(axis=0))
+            results['test_acc_std'], results['test_mae_std'] = member_results.std(axis=0)
+
+        if args.suffix == 'True':
+            suffix_scores = []
+            suffix_seconds = 0.0
+            for trained_restart, trained_model in enumerate(trained, restart):
+                results_path = args.suffix_results
+                if results_path is not None and n_restarts > 1:
+                    # One results file per restart
+                    stem, extension = os.path.splitext(results_path)
+                    results_path = '%s_restart%d%s' % (stem, trained_restart, extension)
+                suffix_start = perf_counter()
+                suffix_scores.append(suffix_prediction(trained_model, X_test, Y_test, 5, args.suffix_batch_size, args.incremental,
+                                                       args.suffix_cache_size, args.beam_width, args.length_penalty,
+                                                       end_of_case, args.suffix_length_cap, results_path,
+                                                       args.suffix_workers, args.suffix_threads, args.precision))
+                suffix_seconds += perf_counter() - suffix_start
+                if args.suffix_samples > 0:
+                    samples_path = None
+                    if results_path is not None:
+                        # The sampled summaries go next to the suffix predictions
+                        stem, extension = os.path.splitext(results_path)
+                        samples_path = '%s_samples%s' % (stem, extension)
+                    sampled_rows, time_quantiles, sequence_frequencies = suffix_sampling(
+                        trained_model, X_test, Y_test, 5, args.suffix_samples, args.suffix_batch_size,
+                        args.incremental, args.temperature, args.top_k, end_of_case, args.suffix_length_cap,
+                        precision=args.precision, results_path=samples_path)
+                    results.setdefault('suffix_sample_rows', []).append(sampled_rows)
+                    results.setdefault('suffix_sample_time_quantiles', []).append(time_quantiles)
+                    results.setdefault('suffix_sample_frequencies', []).append(sequence_frequencies)
+            results['suffix_similarity'], results['suffix_mae'] = np.mean(suffix_scores, axis=0)
+            results['suffix_seconds'] = suffix_seconds / len(trained)
+
+    return results
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--data', help='which dataset to use, gen or orig',default='gen')
     parser.add_argument('-s', '--suffix', help='compute suffix', default='False')
-    args = parser.parse_args()
-    run(args.data, args.suffix)
+    parser.add_argument('--suffix_batch_size', help='prefixes decoded together during suffix prediction', type=int, default=1024)
+    parser.add_argument('--incremental', help='carry the LSTM states between suffix decoding steps and feed only the new event, instead of re-running the sliding window', action='store_true')
+    parser.add_argument('--suffix_cache_size', help='prefix windows whose decoded suffix is kept for reuse, 0 disables the cache, as do xavier initial states', type=int, default=65536)
+    parser.add_argument('--beam_width', help='partial suffixes kept per prefix during suffix prediction, 1 decodes greedily', type=int, default=1)
+    parser.add_argument('--length_penalty', help='exponent of the suffix length that beam scores are divided by', type=float, default=1.0)
+    parser.add_argument('--end_of_case', help='train on the eoc_ files that close every case with an end-of-case activity, and decode suffixes until it is predicted', action='store_true')
+    parser.add_argument('--suffix_length_cap', help='events decoded at most per prefix when decoding until the end of case', type=int, default=50)
+    parser.add_argument('--suffix_results', help='CSV file that per-prefix suffix predictions are appended to while decoding; an existing file resumes the evaluation', default=None)
+    parser.add_argument('--suffix_workers', help='worker processes that decode whole test cases in parallel on the CPU', type=int, default=1)
+    parser.add_argument('--suffix_threads', help='torch threads per suffix worker, by default the cores are split evenly', type=int, default=None)
+    parser.add_argument('--suffix_samples', help='sampled suffixes per prefix for remaining time quantiles and suffix frequencies, written to a _samples file next to --suffix_results, 0 skips sampling', type=int, default=0)
+    parser.add_argument('--temperature', help='temperature of the activity distribution when sampling suffixes', type=float, default=1.0)
+    parser.add_argument('--top_k', help='sample only among the k most likely activities, 0 samples among all', type=int, default=0)
+    parser.add_argument('--eval_interval', help='evaluate every n training steps', type=int, default=50)
+    parser.add_argument('--eval_batch_size', help='prefixes per evaluation forward pass', type=int, default=4096)
+    parser.add_argument('--precision', help='bfloat16 runs the forward passes of training, evaluation and suffix decoding under bfloat16 autocast, losses and penalties stay float32', choices=['float32', 'bfloat16'], default='float32')
+    parser.add_argument('--quantize', help='report the test metrics and decode suffixes with dynamically int8 quantized copies of the trained models, on the CPU', action='store_true')
+    parser.add_argument('--compile', help='compute the training loss, forward pass included, through torch.compile, falling back to eager execution if compiling fails', action='store_true')
+    parser.add_argument('--hidden_size', help='overrides the LSTM hidden size of the script', type=int, default=None)
+    parser.add_argument('--lr', help='overrides the learning rate of the script', type=float, default=None)
+    parser.add_argument('--restarts', help='overrides the number of models trained from different initial weights', type=int, default=None)
+    parser.add_argument('--ensemble', help='train all restarts at once as one model with stacked weights, and report their mean and standard deviation', action='store_true')
+    parser.add_argument('--patience', help='stop training once the validation loss has not improved for this many checks and restore the best model, 0 trains for the fixed number of steps', type=int, default=0)
+    parser.add_argument('--validation_fraction', help='share of every training environment, in whole cases, held out for early stopping', type=float, default=0.1)
+    parser.add_argument('--validation_interval', help='check the validation loss every n training steps', type=int, default=10)
+    parser.add_argument('--min_delta', help='smallest decrease of the validation loss that counts as an improvement', type=float, default=0.0)
+    parser.add_argument('--checkpoint', help='file the model, optimizer, scheduler and RNG states are saved to during training', default=None)
+    parser.add_argument('--checkpoint_interval', help='save a checkpoint every n training steps and after the last one', type=int, default=100)
+    parser.add_argument('--resume', help='continue training from --checkpoint if it exists', action='store_true')
+    parser.add_argument('--evaluate_only', help='with --resume, evaluate the checkpointed model without training further', action='store_true')
+    parser.add_argument('--init_state', help='initial LSTM states: xavier (re-drawn every forward), cached zeros or learned', choices=['xavier', 'zeros', 'learned'], default='xavier')
+    parser.add_argument('--architecture', help='two_tower: separate LSTMs per head, shared: one LSTM feeds both heads, shared_adapter: shared LSTM with a small adapter per head', choices=['two_tower', 'shared', 'shared_adapter'], default='two_tower')
+    return parser.parse_args(argv)
+
+def main():
+    run(parse_args())
 
 
 if __name__ == '__main__':
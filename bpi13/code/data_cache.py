@@ -0,0 +1,29 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+arrays = {}
+
+
+def read_csv_array(path):
+    # Parsed CSVs are kept in memory for later runs in the same process, and as .npy
+    # files in a cache directory next to the CSV for other processes. Both are rebuilt
+    # when the CSV changes. Callers get a copy they are free to modify.
+    modified = os.path.getmtime(path)
+    if path in arrays and arrays[path][0] == modified:
+        return arrays[path][1].copy()
+    directory, name = os.path.split(path)
+    cache_path = os.path.join(directory, 'cache', os.path.splitext(name)[0] + '.npy')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= modified:
+        array = np.load(cache_path)
+    else:
+        array = pd.read_csv(path).to_numpy()
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Written under a temporary name first, as several trials may build it at once
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            np.save(file, array)
+        os.replace(temporary_path, cache_path)
+    arrays[path] = (modified, array)
+    return array.copy()
@@ -1,3 +1,4 @@
+import argparse
 import pandas as pd
 from datetime import datetime
 from datetime import timedelta
@@ -32,9 +33,19 @@ def generatePadding(float_bool, padding_list, ngram_size):
 
     return X, Y
 
-def generateNgram():
+def appendEndOfCase(df, activity_column, end_of_case):
+    # Close every case with a copy of its last event that carries the end-of-case
+    # activity and no elapsed time, so the full prefix of a case learns that it is over
+    last_events = df.groupby('case:concept:name', sort=False).tail(1).copy()
+    last_events[activity_column] = end_of_case
+    if 'time_delta' in last_events:
+        last_events['time_delta'] = 0.0
+    return pd.concat([df, last_events]).sort_index(kind='stable').reset_index(drop=True)
+
+def generateNgram(end_of_case=False):
 
     MAX_NGRAM_SIZE = 10  
+    prefix = '../data/BPI13_gen_eoc_' if end_of_case else '../data/BPI13_gen_'
 
     env1_X = []
     env1_Y = []
@@ -51,6 +62,12 @@ def generateNgram():
 
     for idx, act in enumerate(tqdm(activity_list, desc='activity')):
         df.loc[df.Activity == act, 'Activity'] = idx + 1
+
+    vocabulary = pd.DataFrame({'activity': activity_list, 'code': range(1, len(activity_list) + 1)})
+    if end_of_case:
+        df = appendEndOfCase(df, 'Activity', len(activity_list) + 1)
+        vocabulary.loc[len(vocabulary)] = ['end of case', len(activity_list) + 1]
+    vocabulary.to_csv(prefix + 'activities.csv', index=False)
     
     for idx, act in enumerate(tqdm(resource_list, desc='resource')):
         df.loc[df['Resource'] == act, 'Resource'] = idx + 1
@@ -110,23 +127,26 @@ def generateNgram():
                 env3_Y.append([activity_Y[j], timestamp_Y[j]])
     
     df_X = pd.DataFrame(env1_X, columns=['activity', 'timestamp', 'resource', 'variant', 'spurious'])
-    df_X.to_csv('../data/Helpdesk_gen_env1_X.csv', index=False)
+    df_X.to_csv(prefix + 'env1_X.csv', index=False)
     df_Y = pd.DataFrame(env1_Y, columns=['activity', 'timestamp'])
-    df_Y.to_csv('../data/Helpdesk_gen_env1_Y.csv', index=False)
+    df_Y.to_csv(prefix + 'env1_Y.csv', index=False)
 
     df_X = pd.DataFrame(env2_X, columns=['activity', 'timestamp', 'resource', 'variant', 'spurious'])
-    df_X.to_csv('../data/Helpdesk_gen_env2_X.csv', index=False)
+    df_X.to_csv(prefix + 'env2_X.csv', index=False)
     df_Y = pd.DataFrame(env2_Y, columns=['activity', 'timestamp'])
-    df_Y.to_csv('../data/Helpdesk_gen_env2_Y.csv', index=False)
+    df_Y.to_csv(prefix + 'env2_Y.csv', index=False)
 
     df_X = pd.DataFrame(env3_X, columns=['activity', 'timestamp', 'resource', 'variant', 'spurious'])
-    df_X.to_csv('../data/Helpdesk_gen_env3_X.csv', index=False)
+    df_X.to_csv(prefix + 'env3_X.csv', index=False)
     df_Y = pd.DataFrame(env3_Y, columns=['activity', 'timestamp'])
-    df_Y.to_csv('../data/Helpdesk_gen_env3_Y.csv', index=False)
+    df_Y.to_csv(prefix + 'env3_Y.csv', index=False)
 
 
 def main():
-    generateNgram()
+    parser = argparse.ArgumentParser(description='turn the event log into n-gram prefixes per environment')
+    parser.add_argument('--end_of_case', help='close every case with an end-of-case activity and write the files with an eoc_ prefix', action='store_true')
+    args = parser.parse_args()
+    generateNgram(args.end_of_case)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,18 @@
+import warnings
+import torch
+
+
+def bfloat16_supported(device):
+    # Native bfloat16 matrix products, otherwise they are emulated and slower than float32
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+
+
+def autocast(device, precision='float32'):
+    # Runs the matrix products and LSTMs of the forward passes inside it in bfloat16.
+    # The models return float32 predictions, so losses, penalties and the decoders'
+    # bookkeeping stay in float32.
+    if precision == 'bfloat16' and not bfloat16_supported(device):
+        warnings.warn('the %s has no native bfloat16 support, mixed precision will be slow' % device.type)
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=precision == 'bfloat16')
@@ -0,0 +1,83 @@
+import argparse
+import importlib
+import itertools
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import torch
+
+
+def parse_values(spec):
+    # name=v1,v2,... sweeps the training script option --name over the listed values
+    name, separator, values = spec.partition('=')
+    if not separator or not values:
+        raise argparse.ArgumentTypeError('expected name=value1,value2,..., got ' + spec)
+    return name.lstrip('-'), values.split(',')
+
+
+def trials(grid, samples, seed):
+    # Every combination of the grid, or samples of them drawn without replacement
+    names = [name for name, _ in grid]
+    configurations = [dict(zip(names, values)) for values in itertools.product(*(values for _, values in grid))]
+    if 0 < samples < len(configurations):
+        configurations = random.Random(seed).sample(configurations, samples)
+    return configurations
+
+
+def init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def run_trial(script_name, script_argv, configuration, seed):
+    # Runs in a worker process. The parsed data files stay cached in the process, so
+    # later trials on the same worker skip reading them. Every trial starts from its
+    # own seed, whichever worker runs it and whatever ran there before.
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    script = importlib.import_module(script_name)
+    overrides = [argument for name, value in configuration.items() for argument in ('--' + name, value)]
+    return script.run(script.parse_args(script_argv + overrides))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='train one model per hyperparameter combination in parallel processes '
+                                                 'and collect the results in a table, any further arguments are passed '
+                                                 'on to the training script')
+    parser.add_argument('script', help='training script to sweep', choices=['rogen', 'camargo', 'camargo_with_irm'])
+    parser.add_argument('-p', '--param', help='training script option and the values to try, e.g. lr=0.01,0.05, '
+                                              'repeat for a grid over several options', type=parse_values, action='append', required=True)
+    parser.add_argument('--samples', help='random search: train this many combinations drawn from the grid, 0 trains all of them', type=int, default=0)
+    parser.add_argument('--seed', help='seed of the random search, trial i is trained from seed + i', type=int, default=0)
+    parser.add_argument('--workers', help='trials trained at the same time', type=int, default=1)
+    parser.add_argument('--threads', help='torch threads per trial, by default the cores are split evenly', type=int, default=None)
+    parser.add_argument('--results', help='CSV file the results table is written to, updated after every trial', default='sweep.csv')
+    args, script_argv = parser.parse_known_args()
+    script = importlib.import_module(args.script)
+
+    configurations = trials(args.param, args.samples, args.seed)
+    threads = args.threads or max(torch.get_num_threads() // args.workers, 1)
+    print("Sweeping", len(configurations), "trials on", args.workers, "workers with", threads, "threads each")
+
+    rows = []
+    with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(threads,)) as pool:
+        futures = {pool.submit(run_trial, args.script, script_argv, configuration, args.seed + trial): configuration
+                   for trial, configuration in enumerate(configurations)}
+        for future in as_completed(futures):
+            result = future.result()
+            rows.append(dict(futures[future], parameters=result['parameters'], seconds_per_step=result['seconds_per_step'],
+                             test_acc=float(result['test_acc']), test_mae=float(result['test_mae'])))
+            pd.DataFrame(rows).to_csv(args.results, index=False)
+
+    names = [name for name, _ in args.param]
+    script.pretty_print(*names, 'seconds/step', 'Next Activity Acc', 'Timestamp Acc')
+    for row in sorted(rows, key=lambda row: -row['test_acc']):
+        script.pretty_print(*(row[name] for name in names), np.float64(row['seconds_per_step']),
+                            np.float64(row['test_acc']), np.float64(row['test_mae']))
+
+
+if __name__ == '__main__':
+    main()
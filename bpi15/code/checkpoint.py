@@ -0,0 +1,65 @@
+import os
+import random
+import tempfile
+import numpy as np
+import torch
+
+
+def rng_states():
+    states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def save_checkpoint(path, model, optimizer, scheduler=None, early_stopping=None, **state):
+    # state holds the step to continue from and any other training loop variables.
+    # The checkpoint is written to a temporary file next to path and renamed over it,
+    # so a crash while saving leaves the previous checkpoint intact.
+    checkpoint = dict(state)
+    checkpoint['model'] = model.state_dict()
+    checkpoint['optimizer'] = optimizer.state_dict()
+    checkpoint['scheduler'] = scheduler.state_dict() if scheduler is not None else None
+    checkpoint['early_stopping'] = early_stopping.state_dict() if early_stopping is not None else None
+    checkpoint['rng'] = rng_states()
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            torch.save(checkpoint, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def load_checkpoint(path):
+    # Loaded onto the CPU; load_state_dict copies the tensors to the model's device
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def restore_checkpoint(checkpoint, model, optimizer=None, scheduler=None, early_stopping=None):
+    # Returns the step training continues from
+    model.load_state_dict(checkpoint['model'])
+    if optimizer is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None and checkpoint['scheduler'] is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    if early_stopping is not None and checkpoint.get('early_stopping') is not None:
+        early_stopping.load_state_dict(checkpoint['early_stopping'])
+    set_rng_states(checkpoint['rng'])
+    return checkpoint['step']
@@ -0,0 +1,25 @@
+import warnings
+import torch
+from torch._dynamo.exc import BackendCompilerFailed, Unsupported
+
+
+class Compiled:
+    # Calls function through torch.compile. When compiling fails, e.g. without a C++
+    # compiler for the CPU backend, it warns once and calls the eager function from
+    # then on. Errors of the function itself are raised as they would be eagerly. The training batches come in a few fixed shapes, one per environment, so
+    # every shape gets its own static graph rather than a dynamic one.
+    # The IRM penalties differentiate the loss twice, which compiled graphs do not
+    # support, so they stay outside of compiled functions.
+    def __init__(self, function, name):
+        self.function = function
+        self.name = name
+        self.compiled = torch.compile(function, dynamic=False)
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except (BackendCompilerFailed, Unsupported) as error:
+                warnings.warn('compiling the %s failed, running it eagerly: %s' % (self.name, error))
+                self.compiled = None
+        return self.function(*args, **kwargs)
@@ -0,0 +1,65 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def worker(rank, run, args):
+    # The cores are split evenly between the local processes
+    torch.set_num_threads(max(torch.get_num_threads() // args.world_size, 1))
+    dist.init_process_group('gloo', init_method='tcp://%s:%d' % (args.master_address, args.master_port),
+                            rank=rank, world_size=args.world_size)
+    try:
+        run(args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(run, args):
+    # Started by torchrun, possibly on several nodes, the process group is set up from
+    # its environment variables. Otherwise --world_size > 1 spawns local processes.
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        dist.init_process_group('gloo')
+        try:
+            return run(args)
+        finally:
+            dist.destroy_process_group()
+    if args.world_size > 1:
+        torch.multiprocessing.spawn(worker, args=(run, args), nprocs=args.world_size)
+        return None
+    return run(args)
+
+
+def broadcast_parameters(model):
+    # Every process starts from the first process's weights
+    if dist.is_initialized():
+        for value in model.state_dict().values():
+            dist.broadcast(value, 0)
+
+
+def all_reduce_gradients(model):
+    # Each process holds the gradient of its own environments' share of the loss, their
+    # sum is the gradient of the whole loss. One flat buffer keeps it to one all-reduce.
+    if not dist.is_initialized():
+        return
+    gradients = [parameter.grad for parameter in model.parameters() if parameter.grad is not None]
+    flat = torch.cat([gradient.flatten() for gradient in gradients])
+    dist.all_reduce(flat)
+    offset = 0
+    for gradient in gradients:
+        gradient.copy_(flat[offset:offset + gradient.numel()].view_as(gradient))
+        offset += gradient.numel()
+
+
+def all_reduce_sum(value):
+    if not dist.is_initialized():
+        return value
+    value = value.clone()
+    dist.all_reduce(value)
+    return value
+
@@ -0,0 +1,177 @@
+import torch
+from torch import nn
+
+
+class LSTMCell(torch.autograd.Function):
+    # The gate nonlinearities and state update of an LSTM step as one autograd node,
+    # which keeps only the activated gates, the previous cell state and tanh of the
+    # new one for the backward pass
+    @staticmethod
+    def forward(ctx, gates, c_prev):
+        hidden_size = c_prev.size(-1)
+        activations = gates.sigmoid()
+        torch.tanh(gates[..., 2 * hidden_size:3 * hidden_size], out=activations[..., 2 * hidden_size:3 * hidden_size])
+        i, f, g, o = activations.chunk(4, dim=-1)
+        c = torch.addcmul(f * c_prev, i, g)
+        tanh_c = torch.tanh(c)
+        ctx.save_for_backward(activations, c_prev, tanh_c)
+        return o * tanh_c, c
+
+    @staticmethod
+    def backward(ctx, grad_h, grad_c):
+        activations, c_prev, tanh_c = ctx.saved_tensors
+        hidden_size = c_prev.size(-1)
+        i, f, g, o = activations.chunk(4, dim=-1)
+        grad_c = grad_h * o * (1 - tanh_c * tanh_c) + (grad_c if grad_c is not None else 0)
+        grad_gates = torch.empty_like(activations)
+        grad_i, grad_f, grad_g, grad_o = grad_gates.chunk(4, dim=-1)
+        torch.mul(grad_c, g, out=grad_i)
+        torch.mul(grad_c, c_prev, out=grad_f)
+        torch.mul(grad_c, i, out=grad_g)
+        torch.mul(grad_h, tanh_c, out=grad_o)
+        # The derivative of the sigmoid gates is s(1 - s), of the tanh gate 1 - g^2
+        derivatives = activations * (1 - activations)
+        derivatives[..., 2 * hidden_size:3 * hidden_size] = 1 - g * g
+        return grad_gates.mul_(derivatives), grad_c * f
+
+
+class StackedLinear(nn.Module):
+    # nn.Linear with one weight matrix per member, applied to inputs of shape
+    # (members, batch, in_features)
+    def __init__(self, linears):
+        super(StackedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.stack([linear.weight.detach() for linear in linears]))
+        self.bias = nn.Parameter(torch.stack([linear.bias.detach() for linear in linears]))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
+
+
+class StackedEmbedding(nn.Module):
+    # nn.Embedding with one table per member, every member looks up the same indices
+    def __init__(self, embeddings):
+        super(StackedEmbedding, self).__init__()
+        self.weight = nn.Parameter(torch.stack([embedding.weight.detach() for embedding in embeddings]))
+
+    def forward(self, indices):
+        members = torch.arange(self.weight.size(0), device=indices.device)
+        return self.weight[members.view(-1, *([1] * indices.dim())), indices]
+
+
+class StackedLSTM(nn.Module):
+    # Batch-first nn.LSTM with one set of weights per member. Inputs have shape
+    # (members, batch, seq_length, input_size) and states (members, num_layers, batch,
+    # hidden_size). The gates are computed with batched matrix products over the
+    # members, in the order of nn.LSTM (input, forget, cell, output).
+    def __init__(self, lstms):
+        super(StackedLSTM, self).__init__()
+        self.num_layers = lstms[0].num_layers
+        self.hidden_size = lstms[0].hidden_size
+        self.dropout = lstms[0].dropout
+        for name in lstms[0]._flat_weights_names:
+            setattr(self, name, nn.Parameter(torch.stack([getattr(lstm, name).detach() for lstm in lstms])))
+
+    def forward(self, x, state):
+        h0, c0 = state
+        members, batch_size, seq_length, _ = x.shape
+        h_n = []
+        c_n = []
+        for layer in range(self.num_layers):
+            weight_ih = getattr(self, 'weight_ih_l%d' % layer)
+            weight_hh = getattr(self, 'weight_hh_l%d' % layer)
+            bias = getattr(self, 'bias_ih_l%d' % layer) + getattr(self, 'bias_hh_l%d' % layer)
+            # The input projections of all time steps in one product. Unbinding them, rather
+            # than indexing every step, gives a single backward node for the projections.
+            input_gates = torch.baddbmm(bias.unsqueeze(1), x.reshape(members, batch_size * seq_length, -1),
+                                        weight_ih.transpose(1, 2)).view(members, batch_size, seq_length, -1)
+            h, c = h0[:, layer], c0[:, layer]
+            outputs = []
+            for step_gates in input_gates.unbind(2):
+                gates = torch.baddbmm(step_gates, h, weight_hh.transpose(1, 2))
+                h, c = LSTMCell.apply(gates, c)
+                outputs.append(h)
+            x = torch.stack(outputs, dim=2)
+            if self.dropout > 0 and layer < self.num_layers - 1:
+                x = nn.functional.dropout(x, self.dropout, self.training)
+            h_n.append(h)
+            c_n.append(c)
+        return x, (torch.stack(h_n, dim=1), torch.stack(c_n, dim=1))
+
+
+class Ensemble(nn.Module):
+    # Trains the restarts of a script's RNN, models of the same architecture but with
+    # their own initial weights, as one model. Every member sees the same batch, and
+    # the predictions of all members come back one after another, so targets repeated
+    # once per member line up with them and a mean loss averages the members' losses.
+    def __init__(self, models):
+        super(Ensemble, self).__init__()
+        template = models[0]
+        self.members = len(models)
+        self.models = models
+        self.hidden_size = template.hidden_size
+        self.num_layers = template.num_layers
+        self.architecture = template.architecture
+        self.init_state = template.init_state
+        self.embedding = StackedEmbedding([model.embedding for model in models]) if hasattr(template, 'embedding') else None
+        self.lstm = StackedLSTM([model.lstm for model in models])
+        if self.architecture == 'two_tower':
+            self.lstm_timestamp = StackedLSTM([model.lstm_timestamp for model in models])
+        self.fc = StackedLinear([model.fc for model in models])
+        self.fc_timestamp = StackedLinear([model.fc_timestamp for model in models])
+        if self.architecture == 'shared_adapter':
+            self.adapter = nn.Sequential(StackedLinear([model.adapter[0] for model in models]), nn.ReLU())
+            self.adapter_timestamp = nn.Sequential(StackedLinear([model.adapter_timestamp[0] for model in models]), nn.ReLU())
+        if self.init_state == 'learned':
+            names = ['h0', 'c0', 'ht', 'ct'] if self.architecture == 'two_tower' else ['h0', 'c0']
+            for name in names:
+                setattr(self, name, nn.Parameter(torch.stack([getattr(model, name).detach() for model in models])))
+        self._zero_states = {}
+
+    def initial_states(self, x):
+        batch_size = x.size(0)
+        if self.init_state == 'learned':
+            learned = (self.h0, self.c0, self.ht, self.ct) if self.architecture == 'two_tower' else (self.h0, self.c0) * 2
+            return [state.expand(-1, -1, batch_size, -1) for state in learned]
+        if self.init_state == 'xavier':
+            states = [x.new_zeros(self.members, self.num_layers, batch_size, self.hidden_size) for _ in range(4)]
+            # Drawn per member, with the fans of the single model's states
+            for state in states:
+                for member_state in state:
+                    torch.nn.init.xavier_uniform_(member_state)
+            return states
+        # As in the single models, one zero tensor per batch shape is reused
+        key = (batch_size, x.device, x.dtype)
+        if key not in self._zero_states:
+            if len(self._zero_states) >= 16:
+                self._zero_states.clear()
+            self._zero_states[key] = x.new_zeros(self.members, self.num_layers, batch_size, self.hidden_size)
+        zeros = self._zero_states[key]
+        return [zeros] * 4
+
+    def forward(self, x):
+        h0, c0, ht, ct = self.initial_states(x)
+        features = x.expand(self.members, -1, -1, -1)
+        if self.embedding is not None:
+            features = torch.cat((self.embedding(x[:, :, 0].long()), features[:, :, :, 1:]), dim=3)
+
+        # The hidden state of the last layer after the last time step
+        _, (h_n, _) = self.lstm(features, (h0, c0))
+        out = h_n[:, -1]
+        if self.architecture == 'two_tower':
+            _, (h_n, _) = self.lstm_timestamp(features, (ht, ct))
+        out_timestamp = h_n[:, -1]
+        if self.architecture == 'shared_adapter':
+            out = self.adapter(out)
+            out_timestamp = self.adapter_timestamp(out_timestamp)
+        out = self.fc(out)
+        out_timestamp = self.fc_timestamp(out_timestamp)
+        # float32 predictions also under bfloat16 autocast
+        return out.flatten(0, 1).float(), torch.flatten(out_timestamp).float()
+
+    def unstack(self):
+        # The trained members as separate models, e.g. for suffix prediction
+        device = next(self.parameters()).device
+        state = self.state_dict()
+        for member, model in enumerate(self.models):
+            model.to(device).load_state_dict({name: value[member] for name, value in state.items()})
+        return self.models
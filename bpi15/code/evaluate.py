@@ -0,0 +1,25 @@
+import argparse
+import importlib
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(description='evaluate a checkpointed model, including suffix prediction, without '
+                                                 'training further, any further arguments are passed on to the training script')
+    parser.add_argument('script', help='training script the checkpoint was written by', choices=['rogen', 'camargo', 'camargo_with_irm'])
+    parser.add_argument('checkpoint', help='checkpoint file written with --checkpoint')
+    args, script_argv = parser.parse_known_args()
+    if not os.path.exists(args.checkpoint):
+        parser.error('no checkpoint at ' + args.checkpoint)
+    script = importlib.import_module(args.script)
+
+    script_args = script.parse_args(script_argv)
+    script_args.checkpoint = args.checkpoint
+    script_args.resume = True
+    script_args.evaluate_only = True
+    script_args.suffix = 'True'
+    script.run(script_args)
+
+
+if __name__ == '__main__':
+    main()
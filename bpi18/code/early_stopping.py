@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+from suffix import case_starts
+from precision import autocast
+
+
+def validation_split(X, Y, fraction):
+    # Holds out the last cases of an environment, about fraction of its prefixes, so
+    # that no case is shared between training and validation
+    first_rows = np.flatnonzero(case_starts(X))
+    later_cases = first_rows[first_rows >= int(len(X) * (1 - fraction))]
+    split = int(later_cases[0]) if len(later_cases) > 0 else len(X)
+    return X[:split], Y[:split], X[split:], Y[split:]
+
+
+def validation_loss(model, X, Y, batch_size, precision='float32'):
+    # Next activity cross entropy plus timestamp L1, the training objective without
+    # the IRM penalty and weight decay, averaged over the members of an ensemble
+    device = next(model.parameters()).device
+    members = getattr(model, 'members', 1)
+    model.eval()
+    total = torch.zeros((), device=device)
+    with torch.no_grad():
+        for start in range(0, len(X), batch_size):
+            X_batch = X[start:start + batch_size].to(device)
+            Y_batch = Y[start:start + batch_size].to(device).repeat(members, 1)
+            with autocast(device, precision):
+                logits, time = model(X_batch)
+            total += torch.nn.functional.cross_entropy(logits, Y_batch[:,0].long(), reduction='sum')
+            total += torch.abs(time - Y_batch[:,1]).sum()
+    model.train()
+    return (total / (len(X) * members)).item()
+
+
+class EarlyStopping:
+    # Keeps a copy of the weights with the lowest validation loss. step() reports when
+    # the loss has not improved by more than min_delta for patience checks in a row.
+    def __init__(self, patience, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = float('inf')
+        self.best_step = None
+        self.best_state = None
+        self.bad_checks = 0
+
+    def step(self, model, loss, step):
+        if loss < self.best_loss - self.min_delta:
+            self.best_loss = loss
+            self.best_step = step
+            self.best_state = {name: value.detach().clone() for name, value in model.state_dict().items()}
+            self.bad_checks = 0
+        else:
+            self.bad_checks += 1
+        return self.bad_checks >= self.patience
+
+    def restore(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+
+    def state_dict(self):
+        return {
+            'best_loss': self.best_loss,
+            'best_step': self.best_step,
+            'best_state': self.best_state,
+            'bad_checks': self.bad_checks,
+        }
+
+    def load_state_dict(self, state):
+        self.best_loss = state['best_loss']
+        self.best_step = state['best_step']
+        self.best_state = state['best_state']
+        self.bad_checks = state['bad_checks']
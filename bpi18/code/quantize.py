@@ -0,0 +1,85 @@
+import argparse
+import copy
+import importlib
+import io
+import os
+import warnings
+import numpy as np
+import torch
+from torch import nn
+
+
+def quantize_model(model):
+    # An int8 copy of a trained model for inference on the CPU. The LSTM and Linear
+    # weights are quantized once, their inputs per batch as they arrive. Embeddings and
+    # learned initial states stay float32. The copy keeps the model's step(), so the
+    # suffix decoders and online predictors use it like the float model.
+    model = copy.deepcopy(model).cpu().eval()
+    with warnings.catch_warnings():
+        # Eager mode quantization is deprecated in favour of torchao, which the
+        # environments of these scripts do not ship
+        warnings.simplefilter('ignore', DeprecationWarning)
+        warnings.filterwarnings('ignore', message='torch.quantize_per_tensor')
+        return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def model_device(model):
+    # Quantized layers keep their packed weights outside of parameters(), a model
+    # without any other parameters runs on the CPU
+    parameter = next(model.parameters(), None)
+    return parameter.device if parameter is not None else torch.device('cpu')
+
+
+def model_bytes(model):
+    # Size of the saved weights
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='evaluate a checkpointed model in float32 and as a dynamically int8 '
+                                                 'quantized copy and compare size, accuracy, suffix similarity and '
+                                                 'decoding time, any further arguments are passed on to the training script')
+    parser.add_argument('script', help='training script the checkpoint was written by', choices=['rogen', 'camargo', 'camargo_with_irm'])
+    parser.add_argument('checkpoint', help='checkpoint file written with --checkpoint')
+    args, script_argv = parser.parse_known_args()
+    if not os.path.exists(args.checkpoint):
+        parser.error('no checkpoint at ' + args.checkpoint)
+    script = importlib.import_module(args.script)
+
+    results = []
+    for quantize in (False, True):
+        script_args = script.parse_args(script_argv)
+        script_args.checkpoint = args.checkpoint
+        script_args.resume = True
+        script_args.evaluate_only = True
+        script_args.suffix = 'True'
+        script_args.quantize = quantize
+        if quantize and script_args.suffix_results is not None:
+            # The int8 predictions go to their own file rather than resuming the float ones
+            stem, extension = os.path.splitext(script_args.suffix_results)
+            script_args.suffix_results = '%s_int8%s' % (stem, extension)
+        print("Quantized " if quantize else "Float32 ")
+        results.append(('int8' if quantize else 'float32', script.run(script_args)))
+
+    reference = results[0][1]
+    script.pretty_print('model', 'bytes', 'Next Activity Acc', 'Timestamp Acc', 'Suffix similarity', 'Suffix MAE',
+                        'suffix seconds', 'speed-up', 'Acc delta', 'Similarity delta')
+    for name, result in results:
+        script.pretty_print(
+            name,
+            np.int64(result['model_bytes']),
+            np.float64(result['test_acc']),
+            np.float64(result['test_mae']),
+            np.float64(result['suffix_similarity']),
+            np.float64(result['suffix_mae']),
+            np.float64(result['suffix_seconds']),
+            np.float64(reference['suffix_seconds'] / result['suffix_seconds']),
+            np.float64(result['test_acc'] - reference['test_acc']),
+            np.float64(result['suffix_similarity'] - reference['suffix_similarity']),
+        )
+
+
+if __name__ == '__main__':
+    main()
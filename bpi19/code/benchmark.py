@@ -0,0 +1,58 @@
+import argparse
+import importlib
+import itertools
+import random
+import numpy as np
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='train one model per architecture, precision and execution mode and compare '
+                                                 'cost and accuracy, any further arguments are passed on to the training script')
+    parser.add_argument('script', help='training script to benchmark', choices=['rogen', 'camargo', 'camargo_with_irm'])
+    parser.add_argument('-a', '--architectures', help='architectures to compare', nargs='+',
+                        choices=['two_tower', 'shared', 'shared_adapter'], default=['two_tower', 'shared', 'shared_adapter'])
+    parser.add_argument('-p', '--precisions', help='precisions to compare, the first is the reference of the metric deltas',
+                        nargs='+', choices=['float32', 'bfloat16'], default=['float32'])
+    parser.add_argument('-e', '--execution', help='eager and/or torch.compile training steps, the first is the reference of the '
+                                                  'metric deltas', nargs='+', choices=['eager', 'compiled'], default=['eager'])
+    parser.add_argument('--seed', help='every run starts from the same random state, so that the deltas do not come from the '
+                                       'initial weights', type=int, default=0)
+    args, script_argv = parser.parse_known_args()
+    script = importlib.import_module(args.script)
+
+    results = []
+    for architecture, precision, execution in itertools.product(args.architectures, args.precisions, args.execution):
+        script_args = script.parse_args(script_argv)
+        script_args.architecture = architecture
+        script_args.precision = precision
+        script_args.compile = execution == 'compiled'
+        print("Architecture ", architecture, "precision ", precision, "execution ", execution)
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        results.append((architecture, precision, execution, script.run(script_args)))
+
+    baseline = results[0][3]['seconds_per_step']
+    # Every architecture's metrics are compared to its own run in the first precision and execution mode
+    reference = {architecture: result for architecture, precision, execution, result in results
+                 if precision == args.precisions[0] and execution == args.execution[0]}
+    script.pretty_print('architecture', 'precision', 'execution', 'parameters', 'first step s', 'seconds/step', 'speed-up',
+                        'Next Activity Acc', 'Timestamp Acc', 'Acc delta', 'Timestamp delta')
+    for architecture, precision, execution, result in results:
+        script.pretty_print(
+            architecture,
+            precision,
+            execution,
+            np.int64(result['parameters']),
+            np.float64(result['first_step_seconds'] or np.nan),
+            np.float64(result['seconds_per_step']),
+            np.float64(baseline / result['seconds_per_step']),
+            result['test_acc'],
+            result['test_mae'],
+            np.float64(result['test_acc'] - reference[architecture]['test_acc']),
+            np.float64(result['test_mae'] - reference[architecture]['test_mae']),
+        )
+
+
+if __name__ == '__main__':
+    main()